@@ -0,0 +1,370 @@
+import json
+import queue
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+import multiprocessing
+
+from datetime import datetime
+from geopandas import GeoDataFrame
+from pathlib import Path
+from rasterio.transform import from_bounds
+from rasterio.windows import transform as wtransform
+from rasterio.windows import Window
+
+from config import buffer_quad_segs, benchmark_folder
+from layers import lod_levels, smoke_mask_public_place_data
+from public_places import INSTITUTIONS
+from state import MaskLayer, write_layer
+from generate_mbtiles import create_vector
+
+from generate_tif import (
+    WindowKind,
+    classify_window,
+    compute_german_window,
+    compute_windows,
+    create_germany_mask,
+    create_german_raster,
+    create_smoke_mask,
+    window_size,
+    _init_german_worker,
+)
+
+try:
+    # Peak memory is only available on unix
+    import resource
+except ImportError:
+    resource = None
+
+
+# Extent of germany, the synthetic outline has roughly the same size
+GERMANY_BOUNDS = (5.9, 47.3, 15.0, 55.1)
+
+# Buffers (in degrees) of the synthetic no smoke and probably no smoke areas,
+# roughly 100m and 150m
+NO_SMOKE_BUFFER = 0.001
+PROBABLY_BUFFER = 0.0015
+
+
+def synthetic_germany(*, seed=0, vertices=4000):
+    # A noisy ellipse filling the extent of germany, bumps of different
+    # sizes give it a border about as ragged as a real one
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radius = 1 + 0.01 * rng.standard_normal(vertices)
+    for k in range(2, 16):
+        radius += 0.1 / k * np.sin(k * angles + rng.uniform(0, 2 * np.pi))
+
+    minx, miny, maxx, maxy = GERMANY_BOUNDS
+    center = ((minx + maxx) / 2, (miny + maxy) / 2)
+    scale = ((maxx - minx) / 2.4, (maxy - miny) / 2.4)
+    outline = shapely.Polygon(np.column_stack([
+        center[0] + scale[0] * radius * np.cos(angles),
+        center[1] + scale[1] * radius * np.sin(angles)]))
+
+    # Keep a single polygon, like the dissolved boundary of the real thing
+    parts = shapely.get_parts(shapely.make_valid(outline))
+    return parts[np.argmax(shapely.area(parts))]
+
+
+def synthetic_places(germany, *, count, seed=0):
+    # Points and short lines (~100m) inside of the outline, half of each,
+    # with the same columns as extracted public places
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = germany.bounds
+    coords = np.empty((0, 2))
+    while len(coords) < count:
+        sample = rng.uniform((minx, miny), (maxx, maxy), (count, 2))
+        inside = shapely.contains_xy(germany, sample[:, 0], sample[:, 1])
+        coords = np.concatenate([coords, sample[inside]])
+    coords = coords[:count]
+
+    lines = count // 2
+    ends = coords[:lines] + rng.uniform(-0.001, 0.001, (lines, 2))
+    shapes = np.concatenate([
+        shapely.linestrings(np.stack([coords[:lines], ends], axis=1)),
+        shapely.points(coords[lines:])])
+
+    return GeoDataFrame({
+        "institution": pd.Categorical(rng.choice(INSTITUTIONS, count),
+                                      categories=INSTITUTIONS),
+        "name": pd.Series([f"Place {i}" for i in range(count)],
+                          dtype="string"),
+    }, geometry=shapes, crs="EPSG:4326")
+
+
+def _write_fixture_layer(path, data, *, explode=True):
+    # Same layout as the state store, including the levels of detail
+    shapes = write_layer(path, data).shapes()
+    for tolerance, level in lod_levels(shapes, explode=explode):
+        write_layer(path.with_name(f"{path.name}.lod-{tolerance}"), level)
+    return MaskLayer(path)
+
+
+def create_fixtures(folder, *, count, seed=0):
+    # Deterministic inputs of all benchmarks, without any network access
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    germany = synthetic_germany(seed=seed)
+    places = synthetic_places(germany, count=count, seed=seed)
+
+    print(f" |> Creating fixtures with {count} places ({folder})")
+    no_smoke = places.copy()
+    no_smoke.geometry = shapely.buffer(places.geometry.to_numpy(),
+                                       NO_SMOKE_BUFFER,
+                                       quad_segs=buffer_quad_segs)
+    probably = places.copy()
+    probably.geometry = shapely.buffer(places.geometry.to_numpy(),
+                                       PROBABLY_BUFFER,
+                                       quad_segs=buffer_quad_segs)
+    return {
+        "places": places,
+        "no_smoke": _write_fixture_layer(folder / "public_place", no_smoke),
+        "probably": _write_fixture_layer(folder / "public_place_probably",
+                                         probably),
+        "germany": _write_fixture_layer(folder / "germany", germany,
+                                        explode=False),
+    }
+
+
+def _sample_windows(fixtures, *, resolution, size, count):
+    # Windows crossing the border or holding no smoke zones, spread evenly
+    # over the raster
+    minx, miny, maxx, maxy = fixtures["germany"].bounds()[0]
+    width = int((maxx - minx) / resolution)
+    height = int((maxy - miny) / resolution)
+    transform = from_bounds(minx, miny, maxx, maxy, width, height)
+
+    no_smoke_tree = fixtures["no_smoke"].index()
+    germany_shape = fixtures["germany"].shape()
+    shapely.prepare(germany_shape)
+    windows = [Window(col, row, min(size, width - col),
+                      min(size, height - row))
+               for row in range(0, height, size)
+               for col in range(0, width, size)]
+    windows = [window for window in windows
+               if classify_window(window=window, transform=transform,
+                                  no_smoke_tree=no_smoke_tree,
+                                  germany_shape=germany_shape)
+               == WindowKind.mixed]
+    step = max(len(windows) // count, 1)
+    return transform, windows[::step][:count]
+
+
+def bench_smoke_mask(fixtures, *, resolution, size, count):
+    transform, windows = _sample_windows(fixtures, resolution=resolution,
+                                         size=size, count=count)
+    no_smoke_tree = shapely.STRtree(fixtures["no_smoke"].shapes())
+    probably_tree = shapely.STRtree(fixtures["probably"].shapes())
+
+    start = time.perf_counter()
+    for window in windows:
+        create_smoke_mask(no_smoke_tree=no_smoke_tree, window=window,
+                          transform=transform,
+                          window_transform=wtransform(window, transform),
+                          probably_tree=probably_tree)
+    return {"seconds": time.perf_counter() - start,
+            "windows": len(windows),
+            "pixels": sum(w.width * w.height for w in windows)}
+
+
+def bench_germany_mask(fixtures, *, resolution, size, count):
+    transform, windows = _sample_windows(fixtures, resolution=resolution,
+                                         size=size, count=count)
+    germany_shape = fixtures["germany"].shape()
+    shapely.prepare(germany_shape)
+
+    start = time.perf_counter()
+    for window in windows:
+        create_germany_mask(germany_shape=germany_shape, window=window,
+                            transform=transform,
+                            window_transform=wtransform(window, transform))
+    return {"seconds": time.perf_counter() - start,
+            "windows": len(windows),
+            "pixels": sum(w.width * w.height for w in windows)}
+
+
+def bench_german_window(fixtures, *, resolution, size, count):
+    transform, windows = _sample_windows(fixtures, resolution=resolution,
+                                         size=size, count=count)
+    # Computed windows end up in a local queue instead of the writer
+    write_queue: queue.Queue = queue.Queue()
+    _init_german_worker(fixtures["no_smoke"], fixtures["probably"],
+                        fixtures["germany"], write_queue)
+
+    start = time.perf_counter()
+    for window in windows:
+        compute_german_window(window, transform)
+        write_queue.get()
+    return {"seconds": time.perf_counter() - start,
+            "windows": len(windows),
+            "pixels": sum(w.width * w.height for w in windows)}
+
+
+def bench_german_raster(fixtures, *, resolution, max_workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = Path(tmp) / "germany.tif"
+        start = time.perf_counter()
+        create_german_raster(out_path=out_path, resolution=resolution,
+                             max_workers=max_workers,
+                             no_smoke_layer=fixtures["no_smoke"],
+                             probably_layer=fixtures["probably"],
+                             germany_layer=fixtures["germany"],
+                             resume=False)
+        seconds = time.perf_counter() - start
+        with rasterio.open(out_path) as dst:
+            # The compute windows the raster was split into, not its blocks
+            windows = len(compute_windows(
+                dst.width, dst.height,
+                window_size(width=dst.width, height=dst.height,
+                            max_workers=max_workers)))
+            pixels = dst.width * dst.height
+            size = out_path.stat().st_size
+    return {"seconds": seconds, "windows": windows, "pixels": pixels,
+            "bytes": size}
+
+
+def bench_public_place_data(fixtures):
+    places = fixtures["places"]
+    start = time.perf_counter()
+    smoke_mask_public_place_data(places)
+    return {"seconds": time.perf_counter() - start,
+            "features": len(places)}
+
+
+def bench_vector(fixtures, *, suffix):
+    layer = fixtures["no_smoke"]
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = Path(tmp) / f"public_places{suffix}"
+        start = time.perf_counter()
+        create_vector(out_path=out_path, layer=layer)
+        seconds = time.perf_counter() - start
+        size = out_path.stat().st_size
+    return {"seconds": seconds, "features": len(layer), "bytes": size}
+
+
+def _peak_rss():
+    # Peak resident memory (in MB) of this process and of its finished
+    # children, e.g. the workers of a process pool
+    if resource is None:
+        return (None, None)
+    return tuple(resource.getrusage(who).ru_maxrss / 1024
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def _run_case(bench, fixtures, params, results):
+    result = bench(fixtures, **params)
+    result["peak_rss_mb"], result["peak_children_rss_mb"] = _peak_rss()
+    results.put(result)
+
+
+def run_case(name, bench, fixtures, **params):
+    # Every case runs in a fresh process, so its peak memory isn't mixed up
+    # with the one of earlier cases
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case,
+                                      args=(bench, fixtures, params, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        print(f" |> \t {name} {params} failed (exit code {process.exitcode})")
+        return None
+    result = results.get()
+
+    # Throughput of everything that was counted
+    seconds = result["seconds"]
+    for unit, key, factor in (("windows", "windows_per_second", 1),
+                              ("pixels", "mpixels_per_second", 1e-6),
+                              ("features", "features_per_second", 1)):
+        if unit in result:
+            result[key] = result[unit] * factor / seconds if seconds else None
+    rates = ", ".join(f"{result[key]:.1f} {key.replace('_per_second', '/s')}"
+                      for key in ("windows_per_second", "mpixels_per_second",
+                                  "features_per_second")
+                      if result.get(key) is not None)
+    print(f" |> \t {name} {params}: {seconds:.2f}s, {rates}, "
+          f"peak {result['peak_rss_mb'] or 0:.0f}MB")
+    return {"name": name, "params": params, **result}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(*, count=20000, seed=0, resolutions=(0.004, 0.002, 0.001),
+                   worker_counts=(1, 4), window_resolution=0.0002,
+                   window_size=2048, window_count=16,
+                   out_dir=benchmark_folder):
+    commit = git_commit()
+    with tempfile.TemporaryDirectory() as tmp:
+        fixtures = create_fixtures(Path(tmp) / "fixtures", count=count,
+                                   seed=seed)
+
+        print(" |> Running benchmarks")
+        window = {"resolution": window_resolution, "size": window_size,
+                  "count": window_count}
+        cases = [
+            ("create_smoke_mask", bench_smoke_mask, window),
+            ("create_germany_mask", bench_germany_mask, window),
+            ("compute_german_window", bench_german_window, window),
+            *(("create_german_raster", bench_german_raster,
+               {"resolution": resolution, "max_workers": max_workers})
+              for resolution in resolutions for max_workers in worker_counts),
+            ("smoke_mask_public_place_data", bench_public_place_data, {}),
+            ("create_vector", bench_vector, {"suffix": ".geojsonl"}),
+            ("create_vector", bench_vector, {"suffix": ".fgb"}),
+        ]
+        results = [run_case(name, bench, fixtures, **params)
+                   for name, bench, params in cases]
+
+    report = {
+        "commit": commit,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "fixtures": {"count": count, "seed": seed},
+        "results": [result for result in results if result is not None],
+    }
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_path = out_dir / (f"{report['time'].replace(':', '-')}"
+                          f"-{commit or 'unknown'}.json")
+    out_path.write_text(json.dumps(report, indent=2))
+    print(f" |> Wrote benchmark results ({out_path})")
+    return out_path
+
+
+def compare_benchmarks(old_path, new_path):
+    # Relative change of the wall time of every case found in both runs,
+    # positive values are slower
+    def cases(path):
+        report = json.loads(Path(path).read_text())
+        return report["commit"], {
+            (result["name"], json.dumps(result["params"], sort_keys=True)):
+                result for result in report["results"]}
+
+    old_commit, old = cases(old_path)
+    new_commit, new = cases(new_path)
+    print(f" |> Comparing {old_commit} with {new_commit}")
+    for key in old.keys() & new.keys():
+        change = new[key]["seconds"] / old[key]["seconds"] - 1
+        print(f" |> \t {key[0]} {key[1]}: {old[key]['seconds']:.2f}s -> "
+              f"{new[key]['seconds']:.2f}s ({change:+.0%})")
+
+
+# Example usage
+if __name__ == "__main__":
+    run_benchmarks()
+
+    # Compare the last two runs
+    runs = sorted(Path(benchmark_folder).glob("*.json"))
+    if len(runs) >= 2:
+        compare_benchmarks(*runs[-2:])
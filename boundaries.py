@@ -0,0 +1,112 @@
+import hashlib
+import json
+import re
+import shutil
+import time
+import uuid
+
+import osmnx as ox
+import shapely
+
+from datetime import datetime
+from pathlib import Path
+
+from config import boundary_cache_folder, boundary_ttl
+from metrics import stage
+
+# Disable type hints and therefore errors for ox library
+from typing import Any
+ox: Any = ox
+
+
+# OSM ids like "R51477" are looked up by id, anything else by name
+OSM_ID = re.compile(r"[NWR]\d+")
+
+# Tolerance (in degrees) of the simplified boundary used for queries, it is
+# grown by the same amount first so it still covers the whole boundary
+QUERY_TOLERANCE = 0.001
+
+# Boundaries already resolved by this process (and its forked workers)
+_resolved: Any = {}
+
+
+def _entry_path(query):
+    key = hashlib.sha256(query.encode()).hexdigest()[:16]
+    return Path(boundary_cache_folder) / key
+
+
+def _read_meta(path):
+    meta_path = path / "meta.json"
+    if not meta_path.exists():
+        return None
+    return json.loads(meta_path.read_text())
+
+
+def fetch_boundary(query):
+    # Union of all geocoded geometries, e.g. the mainland and the islands
+    with stage("boundary.geocode", query=query):
+        gdf = ox.geocode_to_gdf(query,
+                                by_osmid=OSM_ID.fullmatch(query) is not None)
+        return shapely.union_all(gdf.geometry.to_numpy())
+
+
+def write_boundary(query, shape):
+    # Exact and simplified boundary plus its bounds, written to a temporary
+    # folder first so concurrent runs never see a half written entry
+    path = _entry_path(query)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".tmp-{uuid.uuid4().hex}")
+    tmp.mkdir()
+
+    simplified = shapely.simplify(
+        shapely.buffer(shape, QUERY_TOLERANCE, quad_segs=2),
+        QUERY_TOLERANCE, preserve_topology=True)
+    (tmp / "boundary.wkb").write_bytes(shapely.to_wkb(shape))
+    (tmp / "query.wkb").write_bytes(shapely.to_wkb(simplified))
+    (tmp / "meta.json").write_text(json.dumps({
+        "query": query,
+        "fetched": time.time(),
+        "bounds": list(shape.bounds),
+    }))
+
+    old = path.with_name(f".old-{uuid.uuid4().hex}")
+    if path.exists():
+        path.rename(old)
+    tmp.rename(path)
+    shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+def resolve_boundary(query, *, ttl=boundary_ttl):
+    # Cache entry of the boundary, fetched again once it is older than
+    # `ttl` seconds. Without a connection an outdated entry is still used
+    path = _entry_path(query)
+    meta = _read_meta(path)
+    if meta is not None and time.time() - meta["fetched"] < ttl:
+        return path
+
+    try:
+        shape = fetch_boundary(query)
+    except Exception as e:
+        if meta is None:
+            print(f" |> Error: Could not fetch the boundary of {query}: {e}")
+            exit(1)
+        fetched = datetime.fromtimestamp(meta["fetched"])
+        print(f" |> Could not refresh the boundary of {query}, using the "
+              f"one from {fetched:%Y-%m-%d}")
+        return path
+    return write_boundary(query, shape)
+
+
+def boundary_shape(query, *, simplified=False, ttl=boundary_ttl):
+    # Prepared boundary of a place, the simplified one covers the exact one
+    # with far fewer vertices (e.g. for Overpass queries)
+    key = (query, simplified)
+    if key not in _resolved:
+        path = resolve_boundary(query, ttl=ttl)
+        name = "query.wkb" if simplified else "boundary.wkb"
+        shape = shapely.from_wkb((path / name).read_bytes())
+        shapely.prepare(shape)
+        _resolved[key] = shape
+    return _resolved[key]
+
@@ -0,0 +1,48 @@
+import numpy as np
+import shapely
+
+from geopandas import GeoDataFrame
+from extraction import fetch_features
+
+
+# Any feature tagged as building, regardless of its kind
+BUILDINGS = ["building"]
+
+
+def empty_buildings():
+    return GeoDataFrame(geometry=[], crs="EPSG:4326")
+
+
+def extract_buildings(place_name, *, near=None, distance=0):
+    # Building footprints of the place, or only the ones within `distance`
+    # meters of the `near` features
+    print(" |> Extracting buildings")
+
+    area = None
+    if near is not None:
+        if near.empty:
+            return empty_buildings()
+        # Meters as degrees of longitude, the larger of both
+        max_lat = np.abs(near.total_bounds[[1, 3]]).max()
+        degrees = distance / (111320 * np.cos(np.radians(max_lat)))
+        area = shapely.union_all(
+            shapely.buffer(near.geometry.to_numpy(), degrees))
+
+    g = fetch_features(place_name, BUILDINGS, area=area)
+    if g is None:
+        print(" |> \t Found no features. Skipping...")
+        return empty_buildings()
+
+    # Only footprints can block the view, buildings mapped as nodes can't
+    footprints = g.geometry[g.geometry.geom_type.isin(
+        ["Polygon", "MultiPolygon"])]
+    print(f" |> \t Found {len(footprints)} buildings")
+
+    return GeoDataFrame(geometry=footprints.values, crs="EPSG:4326")
+
+
+# Example usage
+if __name__ == "__main__":
+    location = "Waldshut, Baden-Wuerttemberg, Germany"
+    b = extract_buildings(location)
+    print(b.head(10))
@@ -10,3 +10,78 @@ debug = False
 ox.settings.max_query_area_size = 500000000000
 ox.settings.use_cache = True
 ox.settings.log_console = debug
+
+# Overpass instance to query, point this to a local instance for tests or
+# large runs (osmnx < 2 calls the setting `overpass_endpoint`)
+overpass_url = None
+if overpass_url is not None:
+    ox.settings.overpass_url = overpass_url
+    ox.settings.overpass_endpoint = overpass_url
+
+# Responses are cached (and can be replayed) from this folder
+ox.settings.cache_folder = "./cache"
+
+# Number of concurrent Overpass queries and size (in degrees) of the grid
+# cells large areas are split into, None queries the area as a whole
+extraction_workers = 4
+extraction_cell_size = 0.5
+
+# Geometries queried by area (e.g. buildings near public places) are
+# grouped into clusters, parts closer than this (in degrees) share a query
+extraction_cluster_gap = 0.01
+
+# Boundaries of places (by name or OSM id like "R51477") are cached in this
+# folder and fetched again after `boundary_ttl` seconds, an outdated
+# boundary is still used when it can't be fetched
+boundary_cache_folder = "./cache/boundaries"
+boundary_ttl = 30 * 24 * 3600
+# Place (or OSM id) of the german boundary
+germany_boundary = "Germany"
+
+# Extract features from a local .osm.pbf file (e.g. from Geofabrik) instead
+# of querying Overpass, the file is expected to only cover the wanted place
+osm_pbf_path = None
+
+# Segments per quarter circle of the no smoke buffers (less is faster but
+# coarser) and the number of features buffered per worker task
+buffer_quad_segs = 16
+buffer_chunk_size = 10000
+
+# Visibility of the no smoke areas around public places, viewpoints are put
+# every `spacing` meters along the outline of a place (at most
+# `max_viewpoints`), places are processed in chunks of `chunk_size`
+visibility_viewpoint_spacing = 10
+visibility_max_viewpoints = 32
+visibility_chunk_size = 500
+# Visible areas are cached per place in this folder
+visibility_cache_folder = "./cache/visibility"
+
+# Internal block size (in pixels) of the german rasters and the memory (in
+# bytes) a single worker may use, windows are computed in whole blocks and
+# sized to fit this budget
+raster_block_size = 1024
+raster_worker_memory = 512 * 2**20
+
+# Binaries used to build the vector tiles
+tippecanoe_bin = "tippecanoe"
+tile_join_bin = "tile-join"
+
+# Results of benchmark.py are written to this folder
+benchmark_folder = "./benchmarks"
+
+# Timings and counters of every stage are collected in this folder, None
+# disables them. Every run gets a JSON trace and a Prometheus textfile, the
+# latter is also written to `metrics_textfile` (e.g. the folder of the node
+# exporter textfile collector). With `metrics_profile` every process also
+# writes a cProfile dump
+metrics_folder = None
+metrics_textfile = None
+metrics_profile = False
+
+# Sharded national runs (shards.py): jobs are queued in this folder, which
+# may be shared between several nodes. A claimed job that wasn't renewed
+# for `shard_lease` seconds is handed out again. Germany is split into its
+# states or, with `shard_cell_size` (in degrees), into grid cells
+shard_queue_folder = "./queue"
+shard_lease = 600
+shard_cell_size = None
@@ -0,0 +1,124 @@
+import math
+
+import osmnx as ox
+import pandas as pd
+import shapely
+import concurrent.futures as con
+
+from config import (
+    debug, extraction_workers, extraction_cell_size, extraction_cluster_gap,
+    osm_pbf_path
+)
+from boundaries import boundary_shape
+from metrics import stage
+from osm_pbf import features_from_pbf
+
+# Disable type hints and therefore errors for ox library
+from typing import Any
+ox: Any = ox
+
+
+def merge_tags(filters):
+    # ["amenity:school", "amenity:college"] -> {"amenity": ["school", ...]}
+    # ["building"] -> {"building": True}, any value of the key matches
+    tags = {}
+    for f in filters:
+        (c, _, i) = f.partition(":")
+        if not i:
+            tags[c] = True
+        elif tags.get(c) is not True:
+            tags.setdefault(c, []).append(i)
+    return tags
+
+
+def split_area(area, cell_size):
+    # Split an area into grid cells of `cell_size` degrees
+    if cell_size is None:
+        return [area]
+
+    minx, miny, maxx, maxy = area.bounds
+    cells = [
+        shapely.box(minx + col * cell_size, miny + row * cell_size,
+                    minx + (col + 1) * cell_size, miny + (row + 1) * cell_size)
+        for col in range(max(1, math.ceil((maxx - minx) / cell_size)))
+        for row in range(max(1, math.ceil((maxy - miny) / cell_size)))
+    ]
+    shapely.prepare(area)
+    return [shapely.intersection(cell, area) for cell in cells
+            if area.intersects(cell)]
+
+
+def query_areas(area, cell_size, gap=extraction_cluster_gap):
+    # Simple polygons for Overpass covering `area`, one convex hull per
+    # cluster of nearby geometries within each sub area. A single hull per
+    # sub area would reach over everything in between
+    areas = []
+    for piece in split_area(area, cell_size):
+        clusters = shapely.get_parts(
+            shapely.buffer(piece, gap / 2, quad_segs=1))
+        areas += list(shapely.convex_hull(clusters))
+    return areas
+
+
+def _fetch_area(area, tags, within=None):
+    with stage("extraction.query") as span:
+        try:
+            features = ox.features_from_polygon(area, tags=tags)
+        except ox._errors.InsufficientResponseError:
+            return None
+        # Only the features within the actual area are kept
+        if within is not None:
+            features = features[features.geometry.intersects(within)]
+        span["features"] = len(features)
+        return features
+
+
+def fetch_features(place_name, filters, *,
+                   max_workers=extraction_workers,
+                   cell_size=extraction_cell_size,
+                   pbf_path=osm_pbf_path, area=None):
+    # Features of the place, or only the ones within `area` if given
+    tags = merge_tags(filters)
+    with stage("extraction", place=place_name, keys=",".join(sorted(tags)),
+               backend="overpass" if pbf_path is None else "pbf") as span:
+        features = _fetch_features(place_name, tags,
+                                   max_workers=max_workers,
+                                   cell_size=cell_size, pbf_path=pbf_path,
+                                   area=area)
+        span["features"] = 0 if features is None else len(features)
+    return features
+
+
+def _fetch_features(place_name, tags, *, max_workers, cell_size, pbf_path,
+                    area):
+    # Offline backend, a single stream over a local extract of the place
+    if pbf_path is not None:
+        if debug:
+            print(f"Reading {tags} from {pbf_path}")
+        return features_from_pbf(pbf_path, tags, area=area)
+
+    # A single query for all tag filters per sub area, sub areas are fetched
+    # concurrently
+    if area is None:
+        # The simplified boundary keeps the queries small
+        areas = split_area(boundary_shape(place_name, simplified=True),
+                           cell_size)
+    else:
+        # Overpass gets simple polygons instead of the parts of (possibly
+        # many) small geometries
+        areas = query_areas(area, cell_size)
+    if debug:
+        print(f"Querying {tags} in {len(areas)} areas")
+
+    with con.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_fetch_area, a, tags, area)
+                   for a in areas]
+        parts = [future.result() for future in con.as_completed(futures)]
+
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return None
+
+    # Features crossing the border of two sub areas are returned twice
+    features: Any = pd.concat(parts)
+    return features[~features.index.duplicated()]
@@ -1,58 +1,222 @@
-import shapely
-import shapely.wkt
-import pandas as pd
+import shutil
 import subprocess
+import time
+
+import pandas as pd
+import shapely
+import concurrent.futures as con
 
+from dataclasses import dataclass
 from pathlib import Path
-from geopandas import GeoDataFrame
+from typing import Any
+from shapely.geometry import mapping
 
+from config import tippecanoe_bin, tile_join_bin
+from metrics import stage, start_run, finish_run
+from mvt import create_mbtiles
 from public_places import extract_public_places
+from buildings import extract_buildings
 from pedestrian_zones import extract_pedestrian_zones
+from state import (
+    state_exists, load_state, dump_state, dirty_regions, state_checksum
+)
+from tile_sinks import read_metadata, write_metadata
+
+try:
+    # Only needed to write FlatGeobuf files
+    import fiona
+except ImportError:
+    fiona = None
 
 from layers import (
+    NO_SMOKE_DISTANCE,
     germany_mask_data,
     smoke_mask_public_place_data,
     smoke_mask_pedestrian_data,
 )
 
 
-def create_vector(*, out_path, wkt, kind=None):
-    gdf = GeoDataFrame(geometry=[shapely.wkt.loads(wkt)])
-    del wkt
-    json = gdf.to_json()
-    print(f" |> Creating {kind + ' ' if kind else ' '}GeoJSON ({out_path})")
-    # Create a new file with wanted metadata
+# Features parsed and written at once by the streaming writers
+FEATURE_CHUNK_SIZE = 10000
+
+
+def _write_geojsonseq(out_path, layer, chunk_size):
+    # Newline delimited GeoJSON, one feature per line, which tippecanoe can
+    # read in parallel (-P)
     with open(out_path, 'w') as f:
-        f.write(json)
+        for attributes, shapes in layer.chunks(chunk_size):
+            properties = attributes.to_json(orient="records", lines=True) \
+                .splitlines() if len(attributes.columns) \
+                else ["{}"] * len(shapes)
+            geometries = shapely.to_geojson(shapes)
+            f.writelines(
+                '{"type":"Feature","properties":%s,"geometry":%s}\n'
+                % (props, geometry)
+                for props, geometry in zip(properties, geometries))
+
+
+def _write_flatgeobuf(out_path, layer, chunk_size):
+    # FlatGeobuf with a spatial index, GDAL buffers the features on disk
+    # until the index is written on close
+    if fiona is None:
+        print(f" |> Error: Please install 'fiona' to write {out_path}!")
+        exit(1)
+
+    # Field types follow the column types, anything else is written as text
+    dtypes = layer.attributes().dtypes
+    types = {column: "int" if pd.api.types.is_integer_dtype(dtype) else
+             "float" if pd.api.types.is_float_dtype(dtype) else "str"
+             for column, dtype in dtypes.items()}
+    casts = {"int": int, "float": float, "str": str}
+    columns = list(types)
+    schema = {
+        "geometry": "Unknown",
+        "properties": types,
+    }
+    with fiona.open(out_path, 'w', driver="FlatGeobuf", schema=schema,
+                    crs="EPSG:4326", SPATIAL_INDEX="YES") as dst:
+        for attributes, shapes in layer.chunks(chunk_size):
+            values = [[None if pd.isna(v) else casts[types[column]](v)
+                       for v in attributes[column]] for column in columns]
+            properties = [dict(zip(columns, row)) for row in zip(*values)] \
+                if columns else [{}] * len(shapes)
+            dst.writerecords(
+                {"geometry": mapping(shape), "properties": props}
+                for shape, props in zip(shapes, properties))
+
+
+def create_vector(*, out_path, layer, kind=None,
+                  chunk_size=FEATURE_CHUNK_SIZE):
+    # Streams the features of a layer to GeoJSONSeq (.geojsonl) or
+    # FlatGeobuf (.fgb), every row of the layer is its own feature
+    print(f" |> Creating {kind + ' ' if kind else ''}vector ({out_path})")
+    with stage("vector", path=str(out_path)) as span:
+        if Path(out_path).suffix == ".fgb":
+            _write_flatgeobuf(out_path, layer, chunk_size)
+        else:
+            _write_geojsonseq(out_path, layer, chunk_size)
+        span["features"] = len(layer)
+        span["bytes"] = Path(out_path).stat().st_size
 
 
 def check_tippecanoe():
     print(" |> Checking of tippecanoe is installed")
-    result = subprocess.run(["tippecanoe", "-v"],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    for binary in (tippecanoe_bin, tile_join_bin):
+        if shutil.which(binary) is None:
+            print(f" |> Error: Please install '{binary}' to continue!")
+            exit(1)
+    print(" |> Success!")
+
+
+# Tippecanoe flags of the build profiles, the max zoom is set per layer
+PROFILES = {
+    # Drops features in dense tiles until they fit, like before
+    "default": ["--drop-densest-as-needed"],
+    # Mask polygons: small polygons are merged into their neighbours instead
+    # of dropped, so no smoke zones never disappear from a tile
+    "mask": ["--coalesce-densest-as-needed",
+             "--extend-zooms-if-still-dropping",
+             "--maximum-tile-bytes=1000000"],
+    # Large outlines with few features, detail is more important than size
+    "outline": ["--detect-shared-borders", "--no-feature-limit",
+                "--no-tile-size-limit", "--simplification=4"],
+    # Everything in every tile, only for small extracts
+    "exact": ["--no-feature-limit", "--no-tile-size-limit",
+              "--no-line-simplification"],
+}
+
+
+@dataclass(frozen=True)
+class TileLayer:
+    name: str
+    in_path: str
+    profile: str = "default"
+    # None lets tippecanoe guess (-zg)
+    max_zoom: Any = None
 
-    if result.returncode == 0:
-        print(" |> Success!")
-    else:
-        print(" |> Error: Please install 'tippecanoe' to continue!")
+
+def create_vector_tiles(layer, out_path, *, state=None):
+    # Builds the MBTiles of a single layer, the log of tippecanoe is written
+    # next to the output instead of being kept in memory. The `state` it was
+    # built from is recorded in its metadata
+    zoom = f"-z{layer.max_zoom}" if layer.max_zoom is not None else "-zg"
+    # Line delimited input can be read in parallel
+    parallel = ["-P"] if Path(layer.in_path).suffix == ".geojsonl" else []
+    log_path = Path(out_path).with_suffix(".log")
+
+    start = time.perf_counter()
+    with stage("tippecanoe", layer=layer.name) as span, \
+            open(log_path, 'w') as log:
+        result = subprocess.run([
+            tippecanoe_bin,
+            zoom, *PROFILES[layer.profile],
+            *parallel,
+            "--layer", layer.name,
+            "--force",
+            "-o", out_path,
+            layer.in_path
+        ], stdout=subprocess.DEVNULL, stderr=log)
+        if result.returncode == 0:
+            span["bytes"] = Path(out_path).stat().st_size
+
+    if result.returncode != 0:
+        print(f" |> Error: Creating {out_path} failed, see {log_path}!")
+        return None
+    if state is not None:
+        write_metadata(out_path, {"state": state})
+    return time.perf_counter() - start
+
+
+def join_vector_tiles(in_paths, out_path):
+    # Single MBTiles with one vector layer per input
+    with stage("tile-join", path=str(out_path)):
+        result = subprocess.run([
+            tile_join_bin,
+            "--force", "--no-tile-size-limit",
+            "-o", out_path,
+            *in_paths
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    if result.returncode != 0:
+        print(f" |> Error: Joining {out_path} failed: \n", result.stderr)
         exit(1)
 
 
-def create_vector_tiles(in_path, out_path, kind=None):
-    print(f" |> Creating {kind + ' ' if kind else ' '}MbTiles ({out_path})")
-    # TODO pjordan: Figure out what flags to pass here
-    result = subprocess.run([
-        "tippecanoe",
-        "-zg", "--drop-densest-as-needed",
-        "--force",
-        "-o", out_path,
-        in_path
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def build_vector_tiles(layers, out_path, *, out_dir="output",
+                       max_workers=2, join=(), state=None):
+    # Builds the layers concurrently (tippecanoe is multi threaded itself,
+    # so only a few at once) and joins them with the already built `join`
+    # layers into a single MBTiles
+    print(f" |> Creating {len(layers)} MbTiles layers...")
+    paths = {layer.name: str(Path(out_dir) / f"{layer.name}.mbtiles")
+             for layer in layers}
+    with con.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(create_vector_tiles, layer, paths[layer.name],
+                            state=state):
+                layer
+            for layer in layers
+        }
+        timings = {futures[future].name: future.result()
+                   for future in con.as_completed(futures)}
+
+    for name, seconds in sorted(timings.items()):
+        if seconds is not None:
+            size = Path(paths[name]).stat().st_size
+            print(f" |> \t {name}: {seconds:.1f}s, {size / 2**20:.1f} MiB")
+    if None in timings.values():
+        exit(1)
 
-    if result.returncode == 0:
-        print(" |> Success!")
-    else:
-        print(" |> Error: \n", result.stderr)
+    in_paths = list(paths.values()) + [
+        str(Path(out_dir) / f"{name}.mbtiles") for name in join
+        if name not in paths and
+        (Path(out_dir) / f"{name}.mbtiles").exists()]
+    start = time.perf_counter()
+    print(f" |> Joining {len(in_paths)} layers ({out_path})")
+    join_vector_tiles(in_paths, out_path)
+    print(f" |> \t {time.perf_counter() - start:.1f}s, "
+          f"{Path(out_path).stat().st_size / 2**20:.1f} MiB")
+    return timings
 
 
 # Example usage
@@ -62,8 +226,13 @@ if __name__ == "__main__":
 
     # Configure what files should be created
     _recover_state = True
+    # Only rebuild layers that changed compared to the previous extraction
+    _incremental = True
     _create_vectors = True
     _create_tiles = True
+    # Without tippecanoe the tiles are encoded in process, straight from the
+    # state store without any GeoJSON in between
+    _use_tippecanoe = shutil.which(tippecanoe_bin) is not None
 
     _create_world = True
     _create_germany_public_places = True
@@ -73,59 +242,127 @@ if __name__ == "__main__":
 
     # Make sure an output folder exists
     Path("output/").mkdir(exist_ok=True)
+    start_run("generate_mbtiles")
 
-    if _create_vectors:
-        if _recover_state and Path(f"state/{location}").exists():
-            no_smoke_public_place_wkt = pd.read_pickle(
-                f"state/{location}/public_place.wkt")
-            no_smoke_pedestrian_wkt = pd.read_pickle(
-                f"state/{location}/pedestrian.wkt")
-            germany_wkt = Path(f"state/{location}/germany.wkt").read_text()
-        else:
+    if _create_vectors or _create_tiles:
+        if not (_recover_state and state_exists(location)):
             public_places = extract_public_places(location)
             pedestrian_zones = extract_pedestrian_zones(location)
+            buildings = extract_buildings(location, near=public_places,
+                                          distance=NO_SMOKE_DISTANCE)
 
             print(" |> Extracting mask data")
-            no_smoke_public_place_wkt = smoke_mask_public_place_data(
-                public_places)
-            no_smoke_pedestrian_wkt = smoke_mask_pedestrian_data(public_places)
-            germany_wkt = germany_mask_data()
+            (no_smoke_public_place,
+             probably_public_place) = smoke_mask_public_place_data(
+                public_places, buildings)
+            no_smoke_pedestrian = smoke_mask_pedestrian_data(
+                pedestrian_zones)
+            germany_shape = germany_mask_data()
 
             print(" |> Dumping mask data")
-            Path(f"state/{location}").mkdir(parents=True, exist_ok=True)
-            no_smoke_public_place_wkt.to_pickle(
-                f"state/{location}/public_place.wkt")
-            no_smoke_pedestrian_wkt.to_pickle(
-                f"state/{location}/pedestrian.wkt")
-            Path(f"state/{location}/germany.wkt").write_text(germany_wkt)
+            dump_state(location, no_smoke_public_place, probably_public_place,
+                       no_smoke_pedestrian, germany_shape)
+            del no_smoke_public_place, probably_public_place
+            del no_smoke_pedestrian, germany_shape
+
+        (public_place_layer, probably_public_place_layer, pedestrian_layer,
+         germany_layer) = load_state(location)
 
+        # Vector tiles are always built as a whole, but layers without any
+        # changes since the state they were built from can be skipped. With
+        # tippecanoe every layer has its own file, otherwise all share one
+        state = state_checksum(location)
+        if _incremental:
+            def built_from(name):
+                return read_metadata(f"output/{name}.mbtiles"
+                                     if _use_tippecanoe else
+                                     "output/germany.mbtiles").get("state")
+
+            def unchanged(names, mask=None):
+                dirties = [dirty_regions(location, built_from(name))
+                           for name in names]
+                return all(dirty is not None and
+                           (mask is None or dirty[mask].is_empty)
+                           for dirty in dirties)
+
+            kept = {"world_map": unchanged(("world_map",))}
+            kept["public_places"] = kept["public_places_probably"] = \
+                unchanged(("public_places", "public_places_probably"), 0)
+            kept["pedestrian_zones"] = unchanged(("pedestrian_zones",), 1)
+            _create_world &= not kept["world_map"]
+            _create_germany_public_places &= not kept["public_places"]
+            _create_germany_pedestrian_zones &= \
+                not kept["pedestrian_zones"]
+
+            # Layers left as they are were still built from this state
+            if _use_tippecanoe:
+                for name, layer_kept in kept.items():
+                    if layer_kept:
+                        write_metadata(f"output/{name}.mbtiles",
+                                       {"state": state})
+            elif all(kept.values()):
+                write_metadata("output/germany.mbtiles", {"state": state})
+
+    if _create_vectors and _use_tippecanoe:
         print(" |> Creating vectors...")
         if _create_world:
-            create_vector(wkt=germany_wkt,
-                          out_path="output/world_map.geojson",
+            create_vector(layer=germany_layer,
+                          out_path="output/world_map.geojsonl",
                           kind="German Border Outline")
         if _create_germany_public_places:
-            create_vector(wkt=germany_wkt,
-                          out_path="output/public_places.geojson",
+            create_vector(layer=public_place_layer,
+                          out_path="output/public_places.geojsonl",
                           kind="German Public Places")
+            create_vector(layer=probably_public_place_layer,
+                          out_path="output/public_places_probably.geojsonl",
+                          kind="German Public Places (probably)")
         if _create_germany_pedestrian_zones:
-            create_vector(wkt=germany_wkt,
-                          out_path="output/pedestrian_zones.geojson",
+            create_vector(layer=pedestrian_layer,
+                          out_path="output/pedestrian_zones.geojsonl",
                           kind="German Pedestrian Zones")
 
-    if _create_tiles:
+    if _create_tiles and not _use_tippecanoe and \
+            (_create_world or _create_germany_public_places or
+             _create_germany_pedestrian_zones):
+        print(" |> Creating tiles in process...")
+        create_mbtiles(out_path="output/germany.mbtiles",
+                       layers={
+                           "world_map": germany_layer,
+                           "public_places": public_place_layer,
+                           "public_places_probably":
+                               probably_public_place_layer,
+                           "pedestrian_zones": pedestrian_layer,
+                       },
+                       zoom="0-16", max_workers=MAX_WORKERS, state=state)
+
+    if _create_tiles and _use_tippecanoe:
         check_tippecanoe()
 
-        print(" |> Creating tiles...")
+        # All layers end up in a single file, unchanged layers are joined
+        # from their previous build
+        layers = []
         if _create_world:
-            print(" |> Creating world tiles...")
-            create_vector_tiles("output/world_map.geojson",
-                                "output/world_map.mbtiles")
+            layers.append(TileLayer("world_map",
+                                    "output/world_map.geojsonl",
+                                    profile="outline", max_zoom=10))
         if _create_germany_public_places:
-            print(" |> Creating germany public places tiles...")
-            create_vector_tiles("output/public_places.geojson",
-                                "output/public_places.mbtiles")
+            layers.append(TileLayer("public_places",
+                                    "output/public_places.geojsonl",
+                                    profile="mask", max_zoom=16))
+            layers.append(TileLayer("public_places_probably",
+                                    "output/public_places_probably.geojsonl",
+                                    profile="mask", max_zoom=16))
         if _create_germany_pedestrian_zones:
-            print(" |> Creating germany pedestrian zone tiles...")
-            create_vector_tiles("output/pedestrian_zones.geojson",
-                                "output/pedestrian_zones.mbtiles")
+            layers.append(TileLayer("pedestrian_zones",
+                                    "output/pedestrian_zones.geojsonl",
+                                    profile="mask", max_zoom=16))
+
+        print(" |> Creating tiles...")
+        build_vector_tiles(layers, "output/germany.mbtiles",
+                           max_workers=MAX_WORKERS // 2 or 1,
+                           join=("world_map", "public_places",
+                                 "public_places_probably",
+                                 "pedestrian_zones"),
+                           state=state)
+
+    finish_run()
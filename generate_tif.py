@@ -1,25 +1,37 @@
 import gc
+import hashlib
+import json
+import math
+import os
+import threading
+import time
 
 import numpy as np
 import rasterio
 import shapely
-import shapely.wkt
 import multiprocessing
 import concurrent.futures as con
-import pandas as pd
 from dataclasses import dataclass
+from enum import Enum
 
 from typing import Any
 from pathlib import Path
-from rasterio.features import geometry_mask
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask, rasterize
+from rasterio.io import MemoryFile
 from rasterio.transform import from_origin, from_bounds
 from rasterio.windows import transform as wtransform
-from rasterio.windows import bounds
+from rasterio.windows import bounds, Window
 from tqdm import tqdm
 
-from config import debug
+from config import debug, raster_block_size, raster_worker_memory
+from metrics import init_worker, stage, start_run, finish_run
 from public_places import extract_public_places
+from buildings import extract_buildings
 from pedestrian_zones import extract_pedestrian_zones
+from state import (
+    state_exists, load_state, dump_state, dirty_regions, state_checksum
+)
 
 
 try:
@@ -30,97 +42,527 @@ except ImportError:
     import gdal2tiles
 
 from layers import (
+    NO_SMOKE_DISTANCE,
     germany_mask_data,
     smoke_mask_public_place_data,
     smoke_mask_pedestrian_data,
 )
 
 
-@dataclass(frozen=True)
-class SmokeMask:
-    forbidden: Any
-    probably: Any
+# Pixel values of the german raster
+NO_DATA = 0
+GERMANY = 1
+PROBABLY_SMOKE = 2
+NO_SMOKE = 3
 
+COLORMAP = {
+    NO_DATA: (0, 0, 0, 0),
+    GERMANY: (0, 255, 0, 255),
+    PROBABLY_SMOKE: (255, 255, 0, 255),
+    NO_SMOKE: (255, 0, 0, 255),
+}
 
-def create_smoke_mask(*, no_smoke_wkt, window, transform, window_transform):
-    no_smoke_gdf = shapely.wkt.loads(no_smoke_wkt)
-    theight, twidth = (window.height, window.width)
 
-    if shapely.box(*bounds(window, transform)) \
-            .intersects(no_smoke_gdf.geometry).any():
-        no_smoke_mask = geometry_mask(no_smoke_gdf.geometry,
-                                      transform=window_transform,
-                                      out_shape=(theight, twidth),
-                                      invert=True,
-                                      all_touched=True)
-        probably_smoke_mask = np.zeros((theight, twidth), dtype=np.bool_)
+class WindowKind(Enum):
+    # Outside of germany without any no smoke zones, left as sparse block
+    empty = "empty"
+    # Completely inside of germany without any no smoke zones
+    interior = "interior"
+    # Everything else, needs to be rasterized
+    mixed = "mixed"
 
-        return SmokeMask(no_smoke_mask, probably_smoke_mask)
 
-    return None
+@dataclass(frozen=True)
+class SmokeMask:
+    forbidden: Any
+    probably: Any
 
 
-def create_germany_mask(*, germany_wkt, window, transform, window_transform):
-    germany_shape = shapely.wkt.loads(germany_wkt)
+# Masks are rasterized into buffers that are kept around by every process,
+# a mask is only valid until the next window of the same process
+_buffers: Any = {}
+
+
+def _buffer(name, shape, fill=0):
+    # Grown (never shrunk) to the largest window seen so far
+    size = shape[0] * shape[1]
+    if name not in _buffers or len(_buffers[name]) < size:
+        _buffers[name] = np.empty(size, dtype=np.uint8)
+    out = _buffers[name][:size].reshape(shape)
+    out.fill(fill)
+    return out
+
+
+def _rasterize_mask(shapes, out, transform):
+    rasterize(shapes, out=out, transform=transform, default_value=1,
+              all_touched=True)
+    return out.view(np.bool_)
+
+
+def _tree_mask(name, tree, window_box, window_transform, out_shape):
+    # Only rasterize the polygons that actually hit this window
+    hits = tree.query(window_box, predicate="intersects") \
+        if tree is not None else []
+    if not len(hits):
+        return None
+    return _rasterize_mask(tree.geometries.take(hits),
+                           _buffer(name, out_shape), window_transform)
+
+
+def create_smoke_mask(*, no_smoke_tree, window, transform, window_transform,
+                      probably_tree=None):
+    out_shape = (window.height, window.width)
+    window_box = shapely.box(*bounds(window, transform))
+
+    no_smoke_mask = _tree_mask("no_smoke", no_smoke_tree, window_box,
+                               window_transform, out_shape)
+    probably_smoke_mask = _tree_mask("probably", probably_tree, window_box,
+                                     window_transform, out_shape)
+    if no_smoke_mask is None and probably_smoke_mask is None:
+        return None
+
+    if no_smoke_mask is None:
+        no_smoke_mask = _buffer("no_smoke", out_shape).view(np.bool_)
+    if probably_smoke_mask is None:
+        probably_smoke_mask = _buffer("probably", out_shape).view(np.bool_)
+    return SmokeMask(no_smoke_mask, probably_smoke_mask)
+
+
+# Cells of the germany quadtree that are rasterized directly
+QUADTREE_LEAF_SIZE = 256
+
+
+def _quadtree_germany_mask(germany_shape, out, cell, window_transform):
+    cell_bounds = bounds(cell, window_transform)
+    cell_box = shapely.box(*cell_bounds)
+    rows, cols = cell.toslices()
+
+    # Homogeneous cells are filled in bulk
+    if germany_shape.contains(cell_box):
+        out[rows, cols] = True
+        return
+    if not germany_shape.intersects(cell_box):
+        return
+
+    # Only cells crossing the border are rasterized, using just the part of
+    # the border inside of them
+    if max(cell.height, cell.width) <= QUADTREE_LEAF_SIZE:
+        piece = shapely.clip_by_rect(germany_shape, *cell_bounds)
+        out[rows, cols] = _rasterize_mask(
+            [piece], _buffer("leaf", (cell.height, cell.width)),
+            wtransform(cell, window_transform))
+        return
+
+    half_h, half_w = (cell.height // 2, cell.width // 2)
+    for row_off, height in ((0, half_h), (half_h, cell.height - half_h)):
+        for col_off, width in ((0, half_w), (half_w, cell.width - half_w)):
+            if height and width:
+                _quadtree_germany_mask(
+                    germany_shape, out,
+                    Window(cell.col_off + col_off, cell.row_off + row_off,
+                           width, height),
+                    window_transform)
+
+
+def create_germany_mask(*, germany_shape, window, transform, window_transform):
     theight, twidth = (window.height, window.width)
-
-    if shapely.box(*bounds(window, transform)).intersects(germany_shape):
-        return geometry_mask([germany_shape], invert=True,
-                             transform=window_transform,
-                             out_shape=(theight, twidth),
-                             all_touched=True)
+    window_box = shapely.box(*bounds(window, transform))
+
+    if germany_shape.contains(window_box):
+        return _buffer("germany", (theight, twidth), 1).view(np.bool_)
+    if germany_shape.intersects(window_box):
+        germany_mask = _buffer("germany", (theight, twidth)).view(np.bool_)
+        _quadtree_germany_mask(germany_shape, germany_mask,
+                               Window(0, 0, twidth, theight),
+                               window_transform)
+        return germany_mask
     return None
 
 
-def compute_german_window(output_path, write_lock,
-                          window, transform,
-                          no_smoke_wkt, germany_wkt):
+# Mask geometries of the current worker process, these are parsed once by
+# `_init_german_worker` instead of being shipped along with every window
+_no_smoke_tree: Any = None
+_probably_tree: Any = None
+_germany_shape: Any = None
+_write_queue: Any = None
+
+
+def _init_german_worker(no_smoke_layer, probably_layer, germany_layer,
+                        write_queue):
+    global _no_smoke_tree, _probably_tree, _germany_shape, _write_queue
+    init_worker()
+    _write_queue = write_queue
+    # Spatial index over all no smoke polygons, so a window only has to look
+    # at the polygons around it
+    _no_smoke_tree = shapely.STRtree(no_smoke_layer.shapes())
+    if probably_layer is not None:
+        _probably_tree = shapely.STRtree(probably_layer.shapes())
+    _germany_shape = germany_layer.shape()
+    shapely.prepare(_germany_shape)
+
+
+def classify_window(*, window, transform, no_smoke_tree, germany_shape,
+                    probably_tree=None):
+    window_box = shapely.box(*bounds(window, transform))
+
+    for tree in (no_smoke_tree, probably_tree):
+        if tree is not None and \
+                len(tree.query(window_box, predicate="intersects")):
+            return WindowKind.mixed
+    if germany_shape.contains(window_box):
+        return WindowKind.interior
+    if not germany_shape.intersects(window_box):
+        return WindowKind.empty
+    return WindowKind.mixed
+
+
+def render_german_window(*, window, transform, no_smoke_tree, germany_shape,
+                         probably_tree=None):
     # Compute all values
     world = np.full((1, window.height, window.width),
-                    190, dtype=np.uint8)
+                    NO_DATA, dtype=np.uint8)
 
     window_transform = wtransform(window, transform)
     smoke_mask = create_smoke_mask(
-        no_smoke_wkt=no_smoke_wkt, window=window,
-        transform=transform, window_transform=window_transform)
-    del no_smoke_wkt
+        no_smoke_tree=no_smoke_tree, window=window,
+        transform=transform, window_transform=window_transform,
+        probably_tree=probably_tree)
 
     germany_mask = create_germany_mask(
-        germany_wkt=germany_wkt, window=window,
+        germany_shape=germany_shape, window=window,
         transform=transform, window_transform=window_transform)
-    del germany_wkt
 
+    # Masks are applied in place, boolean indexing would allocate the
+    # indices of all marked pixels first
     if germany_mask is not None:
         # Mark germany as green initially
-        world[0, germany_mask] = 1
+        np.copyto(world[0], GERMANY, where=germany_mask)
         del germany_mask
 
     if smoke_mask:
         # Mark probably smoke zones
-        world[0, smoke_mask.probably] = 2
+        np.copyto(world[0], PROBABLY_SMOKE, where=smoke_mask.probably)
 
         # Mark no smoke zones
-        world[0, smoke_mask.forbidden] = 3
+        np.copyto(world[0], NO_SMOKE, where=smoke_mask.forbidden)
         del smoke_mask
 
-    # Write out computed values at correct position
-    with write_lock:
-        if debug:
-            print(f"Writing {window} to file")
-        with rasterio.open(output_path, 'r+') as dst:
-            dst.write(world, window=window)
-        if debug:
-            print(f"Finished writing {window} to file")
+    return world
+
+
+def compute_german_window(window, transform, kind=WindowKind.mixed):
+    # Constant blocks, the writer expands them
+    if kind == WindowKind.interior:
+        _write_queue.put((window, GERMANY))
+        return
+    if kind == WindowKind.empty:
+        _write_queue.put((window, NO_DATA))
+        return
+
+    with stage("raster.window") as span:
+        world = render_german_window(window=window, transform=transform,
+                                     no_smoke_tree=_no_smoke_tree,
+                                     germany_shape=_germany_shape,
+                                     probably_tree=_probably_tree)
+        span["features"] = 1
+
+    # Hand the computed values over to the writer, this blocks while the
+    # queue is full so finished windows can't pile up in memory
+    with stage("write.wait"):
+        _write_queue.put((window, world))
+
+
+# Written windows are made durable (and journaled) in batches of this size
+CHECKPOINT_WINDOWS = 64
+
+
+def journal_paths(out_path):
+    # Journal of the written windows and progress of a raster job, both live
+    # next to the raster until the job is finished
+    return (Path(f"{out_path}.journal"), Path(f"{out_path}.progress.json"))
+
+
+def read_journal(journal_path, job):
+    # Windows written by an interrupted run of the same job, or None
+    if not journal_path.exists():
+        return None
+    lines = journal_path.read_text().splitlines()
+    if not lines or json.loads(lines[0]) != job:
+        return None
+    # The last line might be cut off by a crash
+    return {tuple(int(v) for v in line.split())
+            for line in lines[1:] if len(line.split()) == 4}
+
+
+def raster_state(out_path):
+    # Checksum of the state a complete raster was built from
+    _, progress_path = journal_paths(out_path)
+    if not Path(out_path).exists() or not progress_path.exists():
+        return None
+    progress = json.loads(progress_path.read_text())
+    return progress.get("state") if progress["stage"] == "done" else None
+
+
+def record_raster_state(out_path, state):
+    # A complete raster left as it is was still built from `state`
+    _, progress_path = journal_paths(out_path)
+    progress = json.loads(progress_path.read_text())
+    write_progress(progress_path, **{**progress, "state": state})
+
+
+def write_progress(progress_path, **progress):
+    # Replaced atomically, so an orchestrator never reads a partial file
+    tmp = progress_path.with_name(progress_path.name + ".tmp")
+    tmp.write_text(json.dumps({**progress, "time": time.time()}))
+    tmp.replace(progress_path)
+
+
+def _german_writer(output_path, write_queue, total, done):
+    # The only process touching the file, it keeps the dataset open and
+    # writes windows in the order they are finished
+    journal_path, progress_path = journal_paths(output_path)
+    start = time.time()
+    pending = []
+
+    def checkpoint(dst):
+        # Closing the dataset flushes all written blocks to disk, only
+        # then the windows are journaled as written. The compressed bytes
+        # written are what the file grew by
+        with stage("write.checkpoint") as span:
+            size = os.path.getsize(output_path)
+            dst.close()
+            span["bytes"] = os.path.getsize(output_path) - size
+            span["features"] = len(pending)
+            with open(journal_path, 'a') as journal:
+                journal.writelines(f"{w.col_off} {w.row_off} {w.width} "
+                                   f"{w.height}\n" for w in pending)
+                journal.flush()
+                os.fsync(journal.fileno())
+        nonlocal done
+        done += len(pending)
+        pending.clear()
+        rate = (done - initial) / max(time.time() - start, 1e-9)
+        write_progress(progress_path, stage="rasterizing", total=total,
+                       done=done, windows_per_second=rate,
+                       eta=(total - done) / rate if rate else None)
+        return rasterio.open(output_path, 'r+')
+
+    initial = done
+    init_worker()
+    with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"):
+        dst = rasterio.open(output_path, 'r+')
+        while (item := write_queue.get()) is not None:
+            window, world = item
+            if np.isscalar(world):
+                world = np.full((1, window.height, window.width),
+                                world, dtype=np.uint8)
+            if debug:
+                print(f"Writing {window} to file")
+            # Only handed to the block cache of GDAL, the checkpoints
+            # write to disk
+            with stage("write.window") as span:
+                dst.write(world, window=window)
+                span["features"] = 1
+            pending.append(window)
+            del world
+            if len(pending) >= CHECKPOINT_WINDOWS:
+                dst = checkpoint(dst)
+        checkpoint(dst).close()
+
+
+def create_german_overviews(out_path, resampling="mode"):
+    # Internal overviews down to roughly a single tile, gdal2tiles then reads
+    # those for the lower zoom levels instead of the full resolution data
+    with rasterio.open(out_path, 'r+') as dst:
+        factors = []
+        while min(dst.width, dst.height) // 2 ** len(factors) > 256:
+            factors.append(2 ** (len(factors) + 1))
+        if not factors:
+            return
+
+        print(f" |> Creating overviews ({out_path})")
+        with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"):
+            dst.build_overviews(factors, Resampling[resampling])
+        dst.update_tags(ns='rio_overview', resampling=resampling)
+
+
+def _overview_region(region, src, dst):
+    # Pixels of the overview whose source pixels intersect the region of the
+    # previous level, padded by one for the rounding of odd sizes
+    x0, y0, x1, y1 = region
+    rx, ry = src.width / dst.width, src.height / dst.height
+    return (max(0, math.floor(x0 / rx) - 1), max(0, math.floor(y0 / ry) - 1),
+            min(dst.width, math.ceil(x1 / rx) + 1),
+            min(dst.height, math.ceil(y1 / ry) + 1))
+
+
+def _overview_block(region, src, dst, resampling):
+    # Resample the region from the previous level the same way gdal builds
+    # the overview: the exact (fractional) source window of the region
+    x0, y0, x1, y1 = region
+    rx, ry = src.width / dst.width, src.height / dst.height
+    sx0, sy0, sx1, sy1 = x0 * rx, y0 * ry, x1 * rx, y1 * ry
+    col, row = max(0, math.floor(sx0) - 1), max(0, math.floor(sy0) - 1)
+    width = min(src.width, math.ceil(sx1) + 1) - col
+    height = min(src.height, math.ceil(sy1) + 1) - row
+    data = src.read(1, window=Window(col, row, width, height))
+    with MemoryFile() as memfile, \
+            memfile.open(driver='MEM', width=width, height=height, count=1,
+                         dtype=data.dtype, nodata=NO_DATA) as mem:
+        mem.write(data, 1)
+        return mem.read(1, window=Window(sx0 - col, sy0 - row,
+                                         sx1 - sx0, sy1 - sy0),
+                        out_shape=(y1 - y0, x1 - x0),
+                        resampling=Resampling[resampling])
+
+
+def update_german_overviews(out_path, windows, resampling="mode"):
+    # Only recompute the overview pixels covering the rewritten windows,
+    # level by level from the previous one like gdal does
+    with rasterio.open(out_path) as dst:
+        levels = len(dst.overviews(1))
+        if dst.tags(ns='rio_overview').get('resampling') != resampling:
+            levels = 0
+    if not levels:
+        create_german_overviews(out_path, resampling)
+        return
+
+    print(f" |> Updating overviews of {len(windows)} windows ({out_path})")
+    regions = [(window.col_off, window.row_off,
+                window.col_off + window.width, window.row_off + window.height)
+               for window in windows]
+    for level in range(levels):
+        source = {} if level == 0 else {'overview_level': level - 1}
+        with rasterio.open(out_path, **source) as src, \
+                rasterio.open(out_path, 'r+', overview_level=level) as dst:
+            regions = [_overview_region(region, src, dst)
+                       for region in regions]
+            for region in regions:
+                x0, y0, x1, y1 = region
+                dst.write(_overview_block(region, src, dst, resampling), 1,
+                          window=Window(x0, y0, x1 - x0, y1 - y0))
+
+
+# Bytes a worker needs per pixel of a window: the window itself, three masks
+# and the pickled copy on its way to the writer, plus some headroom
+WINDOW_BYTES_PER_PIXEL = 6
+
+
+def window_size(*, width, height, max_workers,
+                block_size=raster_block_size,
+                worker_memory=raster_worker_memory):
+    # Largest square window (in whole blocks) within the memory budget of a
+    # worker, but small enough to leave a few windows for every worker so
+    # the pool stays balanced
+    side = int(math.sqrt(worker_memory / WINDOW_BYTES_PER_PIXEL))
+    blocks = max(1, side // block_size)
+    while blocks > 1 and math.ceil(width / (blocks * block_size)) * \
+            math.ceil(height / (blocks * block_size)) < 4 * max_workers:
+        blocks -= 1
+    return blocks * block_size
+
+
+def compute_windows(width, height, size):
+    # Windows covering the raster, every window covers whole blocks
+    return [Window(col, row, min(size, width - col), min(size, height - row))
+            for row in range(0, height, size)
+            for col in range(0, width, size)]
+
+
+def _wait_for_windows(futures, *, writer, pbar):
+    # Returns the error of the first failed window, or stops early once the
+    # writer is gone, e.g. killed for running out of memory
+    pending = set(futures)
+    while pending and writer.is_alive():
+        done, pending = con.wait(pending, timeout=1,
+                                 return_when=con.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                return future.exception()
+            pbar.update(1)
+    return None
+
+
+def _discard_windows(write_queue):
+    while True:
+        write_queue.get()
+
+
+def _abort_windows(futures, *, writer, write_queue):
+    # Windows not started yet are dropped, the running ones still hand over
+    # their values. Without a writer those are discarded, otherwise the
+    # workers would block on the full queue forever
+    for future in futures:
+        future.cancel()
+    while writer.is_alive() and \
+            not all(future.done() for future in futures):
+        time.sleep(0.1)
+    if not writer.is_alive():
+        threading.Thread(target=_discard_windows, args=(write_queue,),
+                         daemon=True).start()
 
 
 def create_german_raster(*, out_path,
                          resolution, max_workers,
-                         no_smoke_wkt, germany_wkt):
+                         no_smoke_layer, germany_layer, probably_layer=None,
+                         overview_resampling="mode", dirty_region=None,
+                         resume=True, state=None, grid_origin=None):
+    # `state` is the checksum of the state the layers belong to, it is
+    # recorded once the raster is complete. Rasters sharing a `grid_origin`
+    # (x, y of the top left corner) have their pixels on the same grid, e.g.
+    # the shards of a national run
     # Extract german bounds
-    minx, miny, maxx, maxy = shapely.wkt.loads(germany_wkt).bounds
-    width = int((maxx - minx) / resolution)
-    height = int((maxy - miny) / resolution)
-    transform = from_bounds(minx, miny, maxx, maxy, width, height)
+    minx, miny, maxx, maxy = germany_layer.bounds()[0]
+
+    # Use the coarsest geometries that are still accurate for the pixel size
+    no_smoke_layer = no_smoke_layer.level(resolution)
+    if probably_layer is not None:
+        probably_layer = probably_layer.level(resolution)
+    germany_layer = germany_layer.level(resolution)
+    germany_shape = germany_layer.shape()
+
+    # Only update the windows touching the changed region of an existing file
+    incremental = dirty_region is not None and Path(out_path).exists()
+
+    if grid_origin is None:
+        width = int((maxx - minx) / resolution)
+        height = int((maxy - miny) / resolution)
+        transform = from_bounds(minx, miny, maxx, maxy, width, height)
+    else:
+        # Whole pixels of the grid covering the bounds
+        x0, y0 = grid_origin
+        col = math.floor((minx - x0) / resolution)
+        row = math.floor((y0 - maxy) / resolution)
+        width = math.ceil((maxx - x0) / resolution) - col
+        height = math.ceil((y0 - miny) / resolution) - row
+        transform = from_origin(x0 + col * resolution,
+                                y0 - row * resolution,
+                                resolution, resolution)
+
+    # Windows are computed in sizes that fit the memory of a worker,
+    # independent of the (much smaller) blocks of the file
+    size = window_size(width=width, height=height, max_workers=max_workers)
+
+    # Continue an interrupted run of the same job, only the windows missing
+    # in its journal are computed
+    journal_path, progress_path = journal_paths(out_path)
+    job = {
+        "width": width,
+        "height": height,
+        "transform": list(transform)[:6],
+        "window": size,
+        "layers": [layer.fingerprint() for layer in
+                   (no_smoke_layer, probably_layer, germany_layer)
+                   if layer is not None],
+        "dirty": hashlib.sha256(shapely.to_wkb(dirty_region)).hexdigest()
+        if incremental else None,
+    }
+    written = read_journal(journal_path, job) \
+        if resume and Path(out_path).exists() else None
+    if resume and Path(out_path).exists() and progress_path.exists() and \
+            json.loads(progress_path.read_text()).get("job") == job:
+        print(f" |> Germany raster is up to date ({out_path})")
+        return
 
     # Raster metadata
     metadata = {
@@ -132,50 +574,120 @@ def create_german_raster(*, out_path,
         'crs': 'EPSG:4326',
         'transform': transform,
         'compress': 'LZW',
-        'blockxsize': 144000,
-        'blockysize': 144000,
+        'blockxsize': raster_block_size,
+        'blockysize': raster_block_size,
+        'BIGTIFF': 'IF_SAFER',
         'tiled': True,
         'photometric': 'RGBA',
+        # Blocks that are never written stay empty and read as nodata
+        'nodata': NO_DATA,
+        'sparse_ok': True,
     }
 
-    print(f" |> Creating germany raster ({out_path})")
-    # Create a new file with wanted metadata
-    with rasterio.open(out_path, 'w', **metadata) as dst:
-        # Extract required windows
-        windows = [window for _, window in dst.block_windows(1)]
+    if incremental or written is not None:
+        print(f" |> {'Resuming' if written is not None else 'Updating'} "
+              f"germany raster ({out_path})")
+        with rasterio.open(out_path) as dst:
+            windows = compute_windows(dst.width, dst.height, size)
+            transform = dst.transform
+
+        if incremental:
+            shapely.prepare(dirty_region)
+            windows = [window for window in windows
+                       if dirty_region.intersects(
+                           shapely.box(*bounds(window, transform)))]
+    else:
+        print(f" |> Creating germany raster ({out_path})")
+        # Create a new file with wanted metadata
+        with rasterio.open(out_path, 'w', **metadata) as dst:
+            dst.write_colormap(1, COLORMAP)
+        windows = compute_windows(width, height, size)
+
+    # Sort out windows that don't need any rasterization, the bounding box
+    # index of the state store is good enough for this
+    no_smoke_tree = no_smoke_layer.index()
+    probably_tree = probably_layer.index() \
+        if probably_layer is not None else None
+    shapely.prepare(germany_shape)
+    kinds = [classify_window(window=window, transform=transform,
+                             no_smoke_tree=no_smoke_tree,
+                             germany_shape=germany_shape,
+                             probably_tree=probably_tree)
+             for window in windows]
+    del no_smoke_tree, probably_tree
+    # Existing windows might have become empty, those have to be cleared
+    jobs = [(window, kind) for window, kind in zip(windows, kinds)
+            if incremental or kind != WindowKind.empty]
+    total = len(jobs)
+    if written is None:
+        journal_path.write_text(json.dumps(job) + "\n")
+    else:
+        jobs = [(window, kind) for window, kind in jobs
+                if (window.col_off, window.row_off, window.width,
+                    window.height) not in written]
+    print(f" |> \t Computing {len(jobs)} of {total} windows of "
+          f"{size}x{size} pixels, {kinds.count(WindowKind.interior)} "
+          f"interior windows")
+
+    # Computed windows are passed to a single writer process through a
+    # bounded queue, at most two windows per worker wait to be written
+    write_queue: Any = multiprocessing.Queue(maxsize=2 * max_workers)
+    writer = multiprocessing.Process(target=_german_writer,
+                                     args=(out_path, write_queue, total,
+                                           total - len(jobs)))
+    writer.start()
+
+    # Workers load the geometries once from the memory mapped state store,
+    # windows only carry their coordinates from here on
+    initargs = (no_smoke_layer, probably_layer, germany_layer, write_queue)
+    del germany_shape
+    gc.collect()
 
-        dst.write_colormap(1, {
-            0: (0, 0, 0, 0),
-            1: (0, 255, 0, 255),
-            2: (255, 255, 0, 255),
-            3: (255, 0, 0, 255)
-        })
+    # compute the actual tif file content across multiple processes
+    with stage("raster", workers=max_workers, path=str(out_path)) as span, \
+            tqdm(total=len(jobs)) as pbar:
+        span["features"] = len(jobs)
+        with con.ProcessPoolExecutor(max_workers=max_workers,
+                                     initializer=_init_german_worker,
+                                     initargs=initargs) as executor:
+            futures = {
+                executor.submit(compute_german_window, window, transform, kind)
+                for window, kind in jobs
+            }
+            error = _wait_for_windows(futures, writer=writer, pbar=pbar)
+            if error is not None or not writer.is_alive():
+                _abort_windows(futures, writer=writer,
+                               write_queue=write_queue)
+
+        # Let the writer drain the remaining windows, the journal keeps the
+        # written ones for the next run to resume from
+        if writer.is_alive():
+            write_queue.put(None)
+        writer.join()
+        if writer.exitcode != 0:
+            print(f" |> Error: Writing {out_path} failed!")
+            exit(1)
+        if error is not None:
+            print(f" |> Error: Computing {out_path} failed: {error}")
+            exit(1)
+
+    write_progress(progress_path, stage="overviews", total=total, done=total)
+    with stage("overviews", path=str(out_path)) as span:
+        if incremental:
+            update_german_overviews(out_path, windows, overview_resampling)
+        else:
+            create_german_overviews(out_path, overview_resampling)
+        span["bytes"] = os.path.getsize(out_path)
+    journal_path.unlink()
+    write_progress(progress_path, stage="done", total=total, done=total,
+                   job=job, state=state)
 
-    gc.collect()
 
-    # write the actual tif file content across multiple processes
-    with tqdm(total=len(windows)) as pbar:
-        with multiprocessing.Manager() as man:
-            write_lock = man.Lock()
-
-            with con.ProcessPoolExecutor(max_workers=max_workers) as executor:
-                futures = {
-                    executor.submit(
-                        compute_german_window,
-                        out_path, write_lock,
-                        window, transform,
-                        no_smoke_wkt, germany_wkt,
-                    ) for window in windows
-                }
-                for _ in con.as_completed(futures):
-                    pbar.update(1)
-
-
-def create_world_raster(*, width, height, out_path, germany_wkt):
+def create_world_raster(*, width, height, out_path, germany_layer):
     # World coverage with a simple pixel degree resolution
     degree = 360 / width
     transform = from_origin(-180, 90, degree, degree)
-    german_box = shapely.box(*shapely.wkt.loads(germany_wkt).bounds)
+    german_box = shapely.box(*germany_layer.bounds()[0])
 
     # Raster metadata
     metadata = {
@@ -215,12 +727,23 @@ def create_world_raster(*, width, height, out_path, germany_wkt):
 
 
 def create_tiles(tif_path, out_dir,
-                 *, zoom="0-3", max_workers=8, no_data=None):
-    gdal2tiles.generate_tiles(tif_path, out_dir,
-                              resume=False, profile="mercator",
-                              resampling='average', kml=False,
-                              srcnodata=no_data, zoom=zoom,
-                              nb_processes=max_workers, )
+                 *, zoom="0-3", max_workers=8, no_data=None, resume=False):
+    # With resume the tiles of an interrupted run for the same raster are
+    # kept and only the missing ones are generated
+    marker = Path(out_dir) / ".incomplete"
+    stat = os.stat(tif_path)
+    source = f"{stat.st_size}:{stat.st_mtime_ns}"
+    resume = resume and marker.exists() and marker.read_text() == source
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    marker.write_text(source)
+
+    with stage("gdal2tiles", path=str(out_dir), zoom=zoom):
+        gdal2tiles.generate_tiles(tif_path, out_dir,
+                                  resume=resume, profile="mercator",
+                                  resampling='average', kml=False,
+                                  srcnodata=no_data, zoom=zoom,
+                                  nb_processes=max_workers, )
+    marker.unlink()
 
 
 # Example usage
@@ -230,6 +753,10 @@ if __name__ == "__main__":
 
     # Configure what files should be created
     _recover_state = True
+    # Only update what changed compared to the previous extraction
+    _incremental = True
+    # Continue interrupted rasters and tile sets where they stopped
+    _resume = True
     _create_tifs = True
     _create_tiles = True
 
@@ -241,44 +768,68 @@ if __name__ == "__main__":
 
     # Make sure an output folder exists
     Path("output/").mkdir(exist_ok=True)
+    start_run("generate_tif")
+
+    public_place_dirty, pedestrian_dirty = (None, None)
+    public_places_tif = "output/germany_map_public_places.tif"
+    pedestrian_tif = "output/germany_map_pedestrian_zones.tif"
 
     if _create_tifs:
-        if _recover_state and Path(f"state/{location}").exists():
-            no_smoke_public_place_wkt = pd.read_pickle(
-                f"state/{location}/public_place.wkt")
-            no_smoke_pedestrian_wkt = pd.read_pickle(
-                f"state/{location}/pedestrian.wkt")
-            germany_wkt = Path(f"state/{location}/germany.wkt").read_text()
-        else:
+        if not (_recover_state and state_exists(location)):
             public_places = extract_public_places(location)
             pedestrian_zones = extract_pedestrian_zones(location)
+            buildings = extract_buildings(location, near=public_places,
+                                          distance=NO_SMOKE_DISTANCE)
 
             print(" |> Extracting mask data")
-            no_smoke_public_place_wkt = smoke_mask_public_place_data(
-                public_places)
-            no_smoke_pedestrian_wkt = smoke_mask_pedestrian_data(public_places)
-            germany_wkt = germany_mask_data()
+            (no_smoke_public_place,
+             probably_public_place) = smoke_mask_public_place_data(
+                public_places, buildings)
+            no_smoke_pedestrian = smoke_mask_pedestrian_data(
+                pedestrian_zones)
+            germany_shape = germany_mask_data()
 
             print(" |> Dumping mask data")
-            Path(f"state/{location}").mkdir(parents=True, exist_ok=True)
-            no_smoke_public_place_wkt.to_pickle(
-                f"state/{location}/public_place.wkt")
-            no_smoke_pedestrian_wkt.to_pickle(
-                f"state/{location}/pedestrian.wkt")
-            Path(f"state/{location}/germany.wkt").write_text(germany_wkt)
+            dump_state(location, no_smoke_public_place, probably_public_place,
+                       no_smoke_pedestrian, germany_shape)
+            del no_smoke_public_place, probably_public_place
+            del no_smoke_pedestrian, germany_shape
+
+        (public_place_layer, probably_public_place_layer, pedestrian_layer,
+         germany_layer) = load_state(location)
+
+        # Every raster is updated from the state it was built from
+        state = state_checksum(location)
+        if _incremental:
+            dirty = dirty_regions(location, raster_state(public_places_tif))
+            public_place_dirty = dirty[0] if dirty is not None else None
+            dirty = dirty_regions(location, raster_state(pedestrian_tif))
+            pedestrian_dirty = dirty[1] if dirty is not None else None
+        # Layers without any changes don't need to be touched at all
+        if public_place_dirty is not None or pedestrian_dirty is not None:
+            _create_world &= not Path("output/world_map.tif").exists()
+        if public_place_dirty is not None and public_place_dirty.is_empty:
+            _create_germany_public_places = False
+            record_raster_state(public_places_tif, state)
+        if pedestrian_dirty is not None and pedestrian_dirty.is_empty:
+            _create_germany_pedestrian_zones = False
+            record_raster_state(pedestrian_tif, state)
 
         print(" |> Creating rasters...")
         if _create_world:
             create_world_raster(width=1440,
                                 height=720,
-                                germany_wkt=germany_wkt,
+                                germany_layer=germany_layer,
                                 out_path="output/world_map.tif")
         if _create_germany_public_places:
             create_german_raster(resolution=0.000001,
                                  max_workers=MAX_WORKERS,
-                                 no_smoke_wkt=no_smoke_public_place_wkt,
-                                 germany_wkt=germany_wkt,
-                                 out_path="output/germany_map_public_places.tif")
+                                 no_smoke_layer=public_place_layer,
+                                 probably_layer=probably_public_place_layer,
+                                 germany_layer=germany_layer,
+                                 dirty_region=public_place_dirty,
+                                 resume=_resume, state=state,
+                                 out_path=public_places_tif)
         if _create_germany_pedestrian_zones:
             # NOTE pjordan: We still need way more precision...
             # tif might not be the best format for this tbh 😅
@@ -292,23 +843,29 @@ if __name__ == "__main__":
             #    to create tiles from
             create_german_raster(resolution=0.000001,
                                  max_workers=MAX_WORKERS,
-                                 no_smoke_wkt=no_smoke_pedestrian_wkt,
-                                 germany_wkt=germany_wkt,
-                                 out_path="output/germany_map_pedestrian_zones.tif")
+                                 no_smoke_layer=pedestrian_layer,
+                                 germany_layer=germany_layer,
+                                 dirty_region=pedestrian_dirty,
+                                 resume=_resume, state=state,
+                                 out_path=pedestrian_tif)
 
     if _create_tiles:
         print(" |> Creating tiles...")
         if _create_world:
             print(" |> Creating world tiles...")
             create_tiles("output/world_map.tif", "output/world_map/",
-                         zoom="0-19", no_data="1")
+                         zoom="0-19", no_data="1", resume=_resume)
         if _create_germany_public_places:
             print(" |> Creating germany tiles...")
-            create_tiles("output/germany_map_public_places.tif",
+            create_tiles(public_places_tif,
                          "output/germany_map_public_places/",
-                         zoom="0-19", max_workers=MAX_WORKERS)
+                         zoom="0-19", max_workers=MAX_WORKERS,
+                         resume=_resume)
         if _create_germany_pedestrian_zones:
             print(" |> Creating germany tiles...")
-            create_tiles("output/germany_map_pedestrian_zones.tif",
+            create_tiles(pedestrian_tif,
                          "output/germany_map_pedestrian_zones/",
-                         zoom="0-19", max_workers=MAX_WORKERS)
+                         zoom="0-19", max_workers=MAX_WORKERS,
+                         resume=_resume)
+
+    finish_run()
@@ -1,51 +1,282 @@
-import osmnx as ox
+import os
 
-from geopandas import GeoDataFrame
+import numpy as np
+import shapely
+import concurrent.futures as con
+
+from geopandas import GeoSeries
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
 from typing import Any
 
+from config import (
+    buffer_quad_segs, buffer_chunk_size, visibility_chunk_size,
+    visibility_viewpoint_spacing, visibility_max_viewpoints,
+    germany_boundary
+)
+from boundaries import boundary_shape
+from metrics import init_worker, stage, count
+from visibility import cache_key, read_cached, write_cached, visible_area
 
-def smoke_mask_pedestrian_data(pedestrian_zones):
-    # Add pedestrian zones
-    pz_shapes = [p.shape for p in pedestrian_zones]
-    pz_gdf: Any = GeoDataFrame(geometry=pz_shapes, crs="EPSG:4326")
 
-    return pz_gdf.to_wkt()
+# Distance in meters around public places in which smoking is forbidden
+NO_SMOKE_DISTANCE = 100
 
 
-def smoke_mask_public_place_data(public_places):
-    # TODO pjordan: We should also take into consideration the buildings around it
-    # Step 1: Find ground level of this building
-    # (might need to be extracted in extract_public_places)
-    # Step 2: Find all buildings in a 100m area around it's outline
-    # (currently we only have knowledge of its center)
-    # Step 3: Mark areas:
-    #    a) Mark all areas as "potentially visible"  100m around the outline
-    #    b) Mark all areas that have a clear direct viewline as "visible"
+# Simplification tolerances (in degrees) of the precomputed levels of detail,
+# a level is used for pixels at least twice as large as its tolerance
+LOD_TOLERANCES = (0.00001, 0.00005, 0.0002, 0.001, 0.005)
 
-    # From what I have found its best to get the topological data using
-    # `elevation`. Which downloads a tif file with topological data
-    # (Or can extend an existing file, like the one we are creating)
-    # We would then need to go over the file again and given all buildings in
-    # the perimeter check if some areas are not visible!
 
-    # Simplified approach for now
-    # Simply mark everything in a 100m area as no smoke
-    pp_shapes = [p.shape for p in public_places]
-    pp_gdf: Any = GeoDataFrame(geometry=pp_shapes, crs="EPSG:4326")
+def lod_levels(shapes, *, explode=True, tolerances=LOD_TOLERANCES):
+    # Dissolved and simplified versions of a layer, exploded into single
+    # polygons again so they can still be indexed
+    dissolved = shapely.union_all(shapes)
+    if explode:
+        # Parts are simplified on their own, keeping the topology between
+        # thousands of parts at once is very slow and overlaps between them
+        # don't matter for a mask
+        dissolved = shapely.get_parts(dissolved)
+    # The dissolved rings start anywhere after any change of the input,
+    # the simplification depends on the start and unchanged parts would
+    # come out different
+    dissolved = shapely.normalize(dissolved)
+    return [(tolerance, shapely.simplify(dissolved, tolerance,
+                                         preserve_topology=True))
+            for tolerance in tolerances]
 
-    # Convert to meter base as intermediate to make growin easier
-    pp_gdf = pp_gdf.to_crs(epsg=32632)
-    pp_gdf.geometry = pp_gdf.buffer(100)
-    pp_gdf = pp_gdf.to_crs(epsg=4326)
 
-    return pp_gdf.to_wkt()
+def utm_epsg(lon, lat):
+    # UTM zone the given coordinate lies in, 32632 only covers western
+    # germany (6°E - 12°E)
+    zone = int((lon + 180) // 6) % 60 + 1
+    return (32600 if lat >= 0 else 32700) + zone
 
 
-def germany_mask_data():
-    # Download the boundary of Germany
-    # germany_gdf = ox.geocode_to_gdf('R51477', by_osmid=True)
-    germany_gdf = ox.geocode_to_gdf('Germany')
+def _to_utm(wkb, epsg):
+    return GeoSeries.from_wkb(wkb, crs="EPSG:4326").to_crs(epsg=epsg)
+
+
+def _to_wgs84(shapes, epsg):
+    return GeoSeries(shapes, crs=f"EPSG:{epsg}").to_crs(epsg=4326).to_numpy()
+
+
+def _merge_labels(buffered, groups):
+    # Overlapping buffers of the same place (same institution and name),
+    # e.g. a school mapped as node and as area, get the same label
+    left, right = shapely.STRtree(buffered).query(buffered,
+                                                  predicate="intersects")
+    same = groups[left] == groups[right]
+    graph = coo_matrix((np.ones(same.sum()), (left[same], right[same])),
+                       shape=(len(buffered), len(buffered)))
+    _, labels = connected_components(graph, directed=False)
+    _, first = np.unique(labels, return_index=True)
+    return labels, first
+
+
+def _merge(shapes, labels, first):
+    # Sorted once, the members of every label are a contiguous run then
+    order = np.argsort(labels, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(labels))[:-1])
+    return [shapely.union_all(shapes[group]) if len(group) > 1 else shapes[i]
+            for i, group in zip(first, groups)]
+
+
+def _buffer_chunk(wkb, groups, epsg, distance, quad_segs):
+    with stage("buffering.chunk") as span:
+        span["features"] = len(wkb)
+        # Convert to meter base as intermediate to make growin easier
+        shapes = _to_utm(wkb, epsg)
+        buffered = _to_wgs84(
+            shapely.buffer(shapes.to_numpy(), distance, quad_segs=quad_segs),
+            epsg)
+
+        labels, first = _merge_labels(buffered, groups)
+        return first, shapely.to_wkb(_merge(buffered, labels, first))
+
+
+def _place_chunks(places, chunk_size):
+    # Chunks of place rows per UTM zone, every chunk is projected into the
+    # UTM zone of its features
+    points = shapely.get_coordinates(
+        places.geometry.representative_point().to_numpy())
+    zones = np.array([utm_epsg(lon, lat) for lon, lat in points])
+
+    chunks = []
+    for epsg in np.unique(zones):
+        # Sort by longitude so chunks (and merges) stay local
+        idx = np.flatnonzero(zones == epsg)
+        idx = idx[np.argsort(points[idx, 0], kind="stable")]
+        chunks += [(epsg, idx[i:i + chunk_size])
+                   for i in range(0, len(idx), chunk_size)]
+    return chunks
+
+
+def _place_groups(places):
+    attributes = places.drop(columns=places.geometry.name)
+    if not len(attributes.columns):
+        return np.zeros(len(places), dtype=int)
+    return attributes.groupby(list(attributes.columns), dropna=False,
+                              observed=True).ngroup().to_numpy()
+
+
+def _with_shapes(places, rows, shapes):
+    # Rows (of the merged places) of the original frame with new geometries
+    data = places.iloc[rows].copy()
+    data[places.geometry.name] = GeoSeries(
+        shapely.from_wkb(shapes), index=data.index, crs="EPSG:4326")
+    return data
+
+
+def buffer_places(places, distance, *, quad_segs=buffer_quad_segs,
+                  chunk_size=buffer_chunk_size, max_workers=None):
+    # Buffers the places in chunks across multiple processes
+    if places.empty:
+        return places
+
+    groups = _place_groups(places)
+    wkb = shapely.to_wkb(places.geometry.to_numpy())
+
+    rows, shapes = [], []
+    with stage("buffering", workers=max_workers or os.cpu_count()) as span, \
+            con.ProcessPoolExecutor(max_workers=max_workers,
+                                    initializer=init_worker) as executor:
+        span["features"] = len(places)
+        futures = {
+            executor.submit(_buffer_chunk, wkb[idx], groups[idx],
+                            epsg, distance, quad_segs): idx
+            for epsg, idx in _place_chunks(places, chunk_size)
+        }
+        for future in con.as_completed(futures):
+            first, merged = future.result()
+            rows.append(futures[future][first])
+            shapes.append(merged)
 
-    # Get shape
-    germany_shape = germany_gdf.unary_union
-    return germany_shape.wkt
+    rows = np.concatenate(rows)
+    order = np.argsort(rows)
+    return _with_shapes(places, rows[order], np.concatenate(shapes)[order])
+
+
+def _visibility_chunk(wkb, groups, epsg, distance, quad_segs, building_wkb):
+    with stage("visibility.chunk") as span:
+        span["features"] = len(wkb)
+        shapes = _to_utm(wkb, epsg).to_numpy()
+        areas = shapely.buffer(shapes, distance, quad_segs=quad_segs)
+        buildings = _to_utm(building_wkb, epsg).to_numpy()
+
+        # Buildings around every place, the buildings of the place itself
+        # (e.g. a school mapped as building) don't block the view
+        place_idx, building_idx = shapely.STRtree(buildings).query(
+            areas, predicate="intersects")
+        blocking = ~shapely.intersects(shapes[place_idx],
+                                       buildings[building_idx])
+        place_idx, building_idx = (place_idx[blocking], building_idx[blocking])
+        starts = np.searchsorted(place_idx, np.arange(len(shapes) + 1))
+
+        # Visible areas are cached per place, only new or changed places (or
+        # places with changed buildings around them) are computed
+        keys, visible, missing = [], [], []
+        for i in range(len(shapes)):
+            near = building_idx[starts[i]:starts[i + 1]]
+            key = cache_key(wkb[i], building_wkb[near], distance, quad_segs,
+                            visibility_viewpoint_spacing,
+                            visibility_max_viewpoints)
+            keys.append(key)
+            visible.append(read_cached(key))
+            if visible[-1] is None:
+                missing.append(i)
+                visible[-1] = visible_area(shapes[i], areas[i],
+                                           buildings[near])
+
+        visible = np.array(visible, dtype=object)
+        if missing:
+            # Reprojecting the cut outlines can leave tiny self intersections
+            visible[missing] = shapely.to_wkb(shapely.make_valid(_to_wgs84(
+                visible[missing].tolist(), epsg)))
+            for i in missing:
+                write_cached(keys[i], visible[i])
+        count("visibility.cache_hits", len(shapes) - len(missing))
+        count("visibility.cache_misses", len(missing))
+
+        areas = _to_wgs84(areas, epsg)
+        labels, first = _merge_labels(areas, groups)
+        return (first, shapely.to_wkb(_merge(areas, labels, first)),
+                shapely.to_wkb(_merge(shapely.from_wkb(visible), labels,
+                                      first)))
+
+
+def visible_places(places, buildings, distance, *,
+                   quad_segs=buffer_quad_segs,
+                   chunk_size=visibility_chunk_size, max_workers=None):
+    # Buffers the places (probably no smoke) and the parts of the buffers
+    # that can be seen from the place (no smoke), in chunks across multiple
+    # processes
+    if places.empty:
+        return (places, places)
+
+    groups = _place_groups(places)
+    wkb = shapely.to_wkb(places.geometry.to_numpy())
+
+    # Every chunk only gets the buildings close to its places, the distance
+    # is converted to degrees of longitude (the larger of both) for this
+    place_shapes = places.geometry.to_numpy()
+    building_shapes = buildings.geometry.to_numpy()
+    building_wkb = shapely.to_wkb(building_shapes)
+    building_tree = shapely.STRtree(building_shapes)
+    max_lat = np.abs(places.total_bounds[[1, 3]]).max()
+    degrees = distance / (111320 * np.cos(np.radians(max_lat)))
+
+    rows, forbidden, probably = [], [], []
+    with stage("visibility", workers=max_workers or os.cpu_count()) as span, \
+            con.ProcessPoolExecutor(max_workers=max_workers,
+                                    initializer=init_worker) as executor:
+        span["features"] = len(places)
+        futures = {}
+        for epsg, idx in _place_chunks(places, chunk_size):
+            _, near = building_tree.query(place_shapes[idx],
+                                          predicate="dwithin",
+                                          distance=degrees)
+            near = np.unique(near)
+            future = executor.submit(_visibility_chunk, wkb[idx], groups[idx],
+                                     epsg, distance, quad_segs,
+                                     building_wkb[near])
+            futures[future] = idx
+        for future in tqdm(con.as_completed(futures), total=len(futures)):
+            first, areas, visible = future.result()
+            rows.append(futures[future][first])
+            probably.append(areas)
+            forbidden.append(visible)
+
+    rows = np.concatenate(rows)
+    order = np.argsort(rows)
+    return (_with_shapes(places, rows[order],
+                         np.concatenate(forbidden)[order]),
+            _with_shapes(places, rows[order],
+                         np.concatenate(probably)[order]))
+
+
+def smoke_mask_pedestrian_data(pedestrian_zones):
+    # Add pedestrian zones
+    pz_gdf: Any = pedestrian_zones
+
+    return pz_gdf
+
+
+def smoke_mask_public_place_data(public_places, buildings=None):
+    # Everything in a 100m area around the outline of a place is probably
+    # no smoke, the parts of it with a direct line of sight to the place
+    # (not hidden behind buildings) are no smoke
+    # NOTE: The ground level (elevation) of the places and buildings is not
+    # taken into account, neither is the height of the buildings
+    if buildings is None or buildings.empty:
+        # Without buildings everything around a place is visible
+        pp_gdf: Any = buffer_places(public_places, NO_SMOKE_DISTANCE)
+        return (pp_gdf, pp_gdf.iloc[:0])
+
+    return visible_places(public_places, buildings, NO_SMOKE_DISTANCE)
+
+
+def germany_mask_data():
+    # Boundary of Germany, downloaded once and then read from the cache
+    return boundary_shape(germany_boundary)
@@ -0,0 +1,243 @@
+import cProfile
+import functools
+import json
+import os
+import time
+import multiprocessing.util
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from config import metrics_folder, metrics_profile, metrics_textfile
+
+
+# Folder of the current run, handed to worker processes through the
+# environment so it survives any process start method
+RUN_ENV = "NO_SMOKE_METRICS_RUN"
+
+# Prefix of all exported Prometheus metrics
+PREFIX = "no_smoke"
+
+_profiler = None
+
+
+def run_folder():
+    folder = os.environ.get(RUN_ENV)
+    return Path(folder) if folder else None
+
+
+def start_run(name, *, folder=metrics_folder):
+    # Everything recorded until `finish_run` ends up in one trace, nothing is
+    # recorded without a metrics folder
+    if folder is None:
+        return None
+    path = Path(folder) / f"{datetime.now():%Y-%m-%dT%H-%M-%S}-{name}"
+    path.mkdir(parents=True, exist_ok=True)
+    os.environ[RUN_ENV] = str(path.resolve())
+    init_worker()
+    return path
+
+
+def init_worker():
+    # Called in every (worker) process, with `metrics_profile` each one
+    # writes a cProfile dump when it exits
+    global _profiler
+    if not metrics_profile or run_folder() is None:
+        return
+    if _profiler is not None:
+        if _profiler[0] == os.getpid():
+            return
+        # Forked workers inherit the profiler of their parent
+        _profiler[1].disable()
+    _profiler = (os.getpid(), cProfile.Profile())
+    _profiler[1].enable()
+    # Pool workers leave through os._exit, only multiprocessing finalizers
+    # still run then (and atexit in the main process)
+    multiprocessing.util.Finalize(None, _dump_profile, exitpriority=10)
+
+
+def _dump_profile():
+    global _profiler
+    if _profiler is None or _profiler[0] != os.getpid():
+        return
+    _profiler[1].disable()
+    _profiler[1].dump_stats(run_folder() / f"profile-{os.getpid()}.prof")
+    _profiler = None
+
+
+def _record(event):
+    folder = run_folder()
+    if folder is None:
+        return
+    # Every process appends to its own file, so no locking is needed
+    with open(folder / f"events-{os.getpid()}.jsonl", "a") as f:
+        f.write(json.dumps(event) + "\n")
+
+
+@contextmanager
+def stage(name, *, workers=None, **labels):
+    # Wall and cpu time of a stage of the pipeline, the caller can fill in
+    # the bytes written and features processed. Stages running a pool pass
+    # its size, their worker utilization is derived from the stages of the
+    # other processes
+    span = {"bytes": 0, "features": 0}
+    if run_folder() is None:
+        yield span
+        return
+
+    start, wall, cpu = (time.time(), time.perf_counter(), time.process_time())
+    try:
+        yield span
+    finally:
+        _record({"type": "stage", "name": name, "labels": labels,
+                 "pid": os.getpid(), "start": start,
+                 "wall": time.perf_counter() - wall,
+                 "cpu": time.process_time() - cpu,
+                 "workers": workers, **span})
+
+
+def timed(name, **labels):
+    # Records every call of the decorated function as a stage, e.g. the
+    # tasks of a process pool
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1, **labels):
+    if run_folder() is None:
+        return
+    _record({"type": "count", "name": name, "labels": labels,
+             "pid": os.getpid(), "start": time.time(), "value": value})
+
+
+def _events(folder):
+    events = []
+    for path in sorted(folder.glob("events-*.jsonl")):
+        with open(path) as f:
+            events += [json.loads(line) for line in f if line.endswith("\n")]
+    return sorted(events, key=lambda event: event["start"])
+
+
+def _utilization(pools, stages):
+    # Share of the pools that was busy with their tasks, stages named
+    # `<pool>.<task>` running in other processes
+    busy, capacity = (0.0, 0.0)
+    for pool in pools:
+        end = pool["start"] + pool["wall"]
+        busy += sum(max(0.0, min(end, s["start"] + s["wall"]) -
+                        max(pool["start"], s["start"]))
+                    for s in stages if s["pid"] != pool["pid"] and
+                    s["name"].startswith(pool["name"] + "."))
+        capacity += pool["wall"] * pool["workers"]
+    return busy / capacity if capacity else 0.0
+
+
+def trace_events(events):
+    # Chrome trace event format, opens in chrome://tracing or Perfetto
+    trace = []
+    for event in events:
+        common = {"name": event["name"], "pid": event["pid"], "tid": 0,
+                  "ts": event["start"] * 1e6}
+        if event["type"] == "stage":
+            trace.append({**common, "ph": "X", "dur": event["wall"] * 1e6,
+                          "args": {**event["labels"], "cpu": event["cpu"],
+                                   "bytes": event["bytes"],
+                                   "features": event["features"]}})
+        else:
+            trace.append({**common, "ph": "C",
+                          "args": {"value": event["value"]}})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+            .replace("\n", "\\n")
+    return ",".join(f'{key}="{escape(value)}"'
+                    for key, value in sorted(labels.items()))
+
+
+def prometheus_text(events, *, run):
+    # Totals per stage (and labels), the format of the node exporter
+    # textfile collector
+    totals = defaultdict(lambda: defaultdict(float))
+    pools = defaultdict(list)
+    stages = [event for event in events if event["type"] == "stage"]
+    for event in stages:
+        key = (event["name"], _labels({"stage": event["name"],
+                                       **event["labels"]}))
+        for field in ("wall", "cpu", "bytes", "features"):
+            totals[key][field] += event[field]
+        totals[key]["calls"] += 1
+        if event["workers"]:
+            pools[key[1]].append(event)
+    counts = defaultdict(float)
+    for event in events:
+        if event["type"] == "count":
+            counts[_labels({"name": event["name"],
+                            **event["labels"]})] += event["value"]
+
+    lines = []
+    for field, metric, kind in (
+            ("wall", "stage_wall_seconds_total", "counter"),
+            ("cpu", "stage_cpu_seconds_total", "counter"),
+            ("bytes", "stage_bytes_total", "counter"),
+            ("features", "stage_features_total", "counter"),
+            ("calls", "stage_calls_total", "counter")):
+        lines.append(f"# TYPE {PREFIX}_{metric} {kind}")
+        lines += [f"{PREFIX}_{metric}{{{labels}}} {values[field]:g}"
+                  for (_, labels), values in sorted(totals.items())]
+
+    lines.append(f"# TYPE {PREFIX}_worker_utilization gauge")
+    lines += [f"{PREFIX}_worker_utilization{{{labels}}} "
+              f"{_utilization(runs, stages):.4f}"
+              for labels, runs in sorted(pools.items())]
+
+    lines.append(f"# TYPE {PREFIX}_count_total counter")
+    lines += [f"{PREFIX}_count_total{{{labels}}} {value:g}"
+              for labels, value in sorted(counts.items())]
+
+    lines.append(f"# TYPE {PREFIX}_run_timestamp_seconds gauge")
+    lines.append(f'{PREFIX}_run_timestamp_seconds{{run="{run}"}} '
+                 f"{time.time():.0f}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path, text):
+    # Scrapers never see a partially written file
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    tmp.replace(path)
+
+
+def finish_run(*, textfile=metrics_textfile):
+    # Merges the events of all processes into `trace.json` and
+    # `metrics.prom` in the run folder (and `textfile` if configured)
+    folder = run_folder()
+    if folder is None:
+        return
+    _dump_profile()
+    events = _events(folder)
+
+    _write_atomic(folder / "trace.json", json.dumps(trace_events(events)))
+    text = prometheus_text(events, run=folder.name)
+    _write_atomic(folder / "metrics.prom", text)
+    if textfile is not None:
+        _write_atomic(textfile, text)
+
+    print(f" |> Wrote metrics ({folder})")
+    top = defaultdict(float)
+    for event in events:
+        if event["type"] == "stage" and event["pid"] == os.getpid():
+            top[event["name"]] += event["wall"]
+    for name, wall in sorted(top.items(), key=lambda item: -item[1])[:5]:
+        print(f" |> \t {name}: {wall:.1f}s")
+    del os.environ[RUN_ENV]
@@ -0,0 +1,300 @@
+import gzip
+import json
+
+import numpy as np
+import shapely
+import concurrent.futures as con
+
+from typing import Any
+from pathlib import Path
+from tqdm import tqdm
+
+from metrics import init_worker, stage, timed
+from tile_sinks import open_sink
+
+from render_tiles import (
+    TILE_SIZE,
+    parse_zoom,
+    pixel_size,
+    tile_blocks,
+    tile_bounds,
+    to_mercator,
+)
+
+
+# Resolution of the tile coordinates and the clip buffer around every tile
+EXTENT = 4096
+BUFFER = 64
+
+# Geometry types and commands of the vector tile specification
+POINT, LINESTRING, POLYGON = (1, 2, 3)
+MOVE_TO, LINE_TO, CLOSE_PATH = (1, 2, 7)
+
+
+def _varints(values):
+    # Protobuf varints of many values at once
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b""
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    groups = (values[:, None] >> shifts) & np.uint64(0x7F)
+    sizes = 1 + (values[:, None] >> shifts[1:] > 0).sum(axis=1)
+    used = np.arange(10) < sizes[:, None]
+    more = np.arange(10) < (sizes - 1)[:, None]
+    groups |= more.astype(np.uint64) << np.uint64(7)
+    return groups[used].astype(np.uint8).tobytes()
+
+
+def _varint(value):
+    return _varints([value])
+
+
+def _key(field, wire_type):
+    return _varint(field << 3 | wire_type)
+
+
+def _bytes_field(field, data):
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _packed_field(field, values):
+    return _bytes_field(field, _varints(values))
+
+
+def _zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return (values << 1) ^ (values >> 63)
+
+
+def _command(command, count):
+    return command & 0x7 | count << 3
+
+
+class _GeometryEncoder:
+    # Command stream of a feature, the cursor carries over between parts
+    def __init__(self):
+        self.cursor = np.zeros(2, dtype=np.int64)
+        self.parts = []
+
+    def _points(self, coords):
+        deltas = np.diff(coords, axis=0, prepend=self.cursor[None])
+        self.cursor = coords[-1]
+        return _zigzag(deltas).ravel()
+
+    def point(self, coords):
+        self.parts += [[_command(MOVE_TO, len(coords))], self._points(coords)]
+
+    def line(self, coords):
+        self.parts += [[_command(MOVE_TO, 1)], self._points(coords[:1]),
+                       [_command(LINE_TO, len(coords) - 1)],
+                       self._points(coords[1:])]
+
+    def ring(self, coords, exterior):
+        # Exteriors have a positive area in tile coordinates (clockwise with
+        # y pointing down), interiors a negative one
+        coords = coords[:-1]
+        x, y = coords.T
+        area = (x * np.roll(y, -1) - np.roll(x, -1) * y).sum()
+        if area == 0:
+            return
+        if (area > 0) != exterior:
+            coords = coords[::-1]
+        self.line(coords)
+        self.parts.append([_command(CLOSE_PATH, 1)])
+
+    def encode(self):
+        return np.concatenate(self.parts) if self.parts else None
+
+
+def encode_geometry(shape):
+    # Geometry type and command stream of a geometry in tile coordinates
+    encoder = _GeometryEncoder()
+    kind = None
+    for part in shapely.get_parts(shape):
+        type_id = shapely.get_type_id(part)
+        if type_id == 0:
+            kind = POINT
+            encoder.point(shapely.get_coordinates(part).astype(np.int64))
+        elif type_id in (1, 2):
+            kind = LINESTRING
+            coords = shapely.get_coordinates(part).astype(np.int64)
+            if len(coords) >= 2:
+                encoder.line(coords)
+        elif type_id == 3:
+            kind = POLYGON
+            rings = [part.exterior, *part.interiors]
+            for i, ring in enumerate(rings):
+                coords = shapely.get_coordinates(ring).astype(np.int64)
+                if len(coords) >= 4:
+                    encoder.ring(coords, exterior=i == 0)
+    return kind, encoder.encode()
+
+
+def encode_layer(name, shapes, properties, ids):
+    # A single layer of a vector tile, keys and values are shared between
+    # all features of the layer
+    keys, values = ({}, {})
+    features = []
+    for shape, props, fid in zip(shapes, properties, ids):
+        kind, geometry = encode_geometry(shape)
+        if geometry is None:
+            continue
+        tags = []
+        for key, value in props.items():
+            if value is None:
+                continue
+            tags += [keys.setdefault(key, len(keys)),
+                     values.setdefault(str(value), len(values))]
+        features.append(_bytes_field(2, b"".join([
+            _key(1, 0) + _varint(fid),
+            _packed_field(2, tags) if tags else b"",
+            _key(3, 0) + _varint(kind),
+            _packed_field(4, geometry),
+        ])))
+
+    if not features:
+        return None
+    return b"".join([
+        _key(15, 0) + _varint(2),
+        _bytes_field(1, name.encode()),
+        *features,
+        *(_bytes_field(3, key.encode()) for key in keys),
+        *(_bytes_field(4, _bytes_field(1, value.encode()))
+          for value in values),
+        _key(5, 0) + _varint(EXTENT),
+    ])
+
+
+# Layers of the current worker process in web mercator, per zoom level
+_layers: Any = None
+_bounds: Any = None
+_zoom_layers: Any = {}
+
+
+def _init_mvt_worker(layers, bounds):
+    global _layers, _bounds
+    init_worker()
+    _layers = layers
+    _bounds = bounds
+
+
+def _load_zoom(z):
+    # Coarser zoom levels use the dissolved levels of detail, these don't
+    # carry any attributes (like coalesced features in tippecanoe)
+    if z not in _zoom_layers:
+        pixel = pixel_size(z, *_bounds) * TILE_SIZE / EXTENT
+        loaded = {}
+        for name, layer in _layers.items():
+            level = layer.level(pixel)
+            shapes = to_mercator(level.shapes())
+            properties = level.attributes().astype(object)
+            properties = properties.where(properties.notna(), None) \
+                .to_dict("records") if len(properties.columns) \
+                else [{}] * len(shapes)
+            loaded[name] = (shapely.STRtree(shapes), shapes, properties)
+        _zoom_layers.clear()
+        _zoom_layers[z] = loaded
+    return _zoom_layers[z]
+
+
+def encode_tile(z, x, y, *, simplify=1.0):
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    scale = EXTENT / (maxx - minx)
+    margin = BUFFER / scale
+    clip = (minx - margin, miny - margin, maxx + margin, maxy + margin)
+
+    def to_tile(coords):
+        return np.column_stack([(coords[:, 0] - minx) * scale,
+                                (maxy - coords[:, 1]) * scale])
+
+    encoded = []
+    for name, (tree, shapes, properties) in _load_zoom(z).items():
+        hits = np.sort(tree.query(shapely.box(*clip)))
+        if not len(hits):
+            continue
+
+        # Clip and simplify in tile coordinates, snapping to the integer
+        # grid keeps the geometries valid
+        clipped = shapely.transform(
+            shapely.clip_by_rect(shapes[hits], *clip), to_tile)
+        clipped = shapely.set_precision(
+            shapely.simplify(clipped, simplify), 1.0)
+        keep = ~shapely.is_empty(clipped)
+
+        layer = encode_layer(name, clipped[keep],
+                             [properties[i] for i in hits[keep]],
+                             hits[keep] + 1)
+        if layer is not None:
+            encoded.append(_bytes_field(3, layer))
+
+    if not encoded:
+        return None
+    return gzip.compress(b"".join(encoded))
+
+
+@timed("vector_tiles.block")
+def encode_tile_block(z, x0, y0, x1, y1, simplify=1.0):
+    # Blocks without any features are skipped as a whole
+    bounds = (*tile_bounds(z, x0, y1)[:2], *tile_bounds(z, x1, y0)[2:])
+    if not any(len(tree.query(shapely.box(*bounds)))
+               for tree, _, _ in _load_zoom(z).values()):
+        return []
+
+    tiles = []
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            data = encode_tile(z, x, y, simplify=simplify)
+            if data is not None:
+                tiles.append((z, x, y, data))
+    return tiles
+
+
+def create_mbtiles(*, out_path, layers, zoom, max_workers, simplify=1.0,
+                   state=None):
+    # Vector tiles of the layers (name -> MaskLayer) without going through
+    # GeoJSON and tippecanoe, tiles are encoded in blocks across multiple
+    # processes and written to a MBTiles (or PMTiles) archive
+    zmin, zmax = parse_zoom(zoom)
+    bounds = np.concatenate([np.asarray(layer.bounds())
+                             for layer in layers.values()])
+    bounds = (*np.nanmin(bounds[:, :2], axis=0),
+              *np.nanmax(bounds[:, 2:], axis=0))
+
+    metadata = {
+        "name": Path(out_path).stem,
+        "format": "pbf",
+        "minzoom": str(zmin),
+        "maxzoom": str(zmax),
+        "bounds": ",".join(str(b) for b in bounds),
+        "json": json.dumps({"vector_layers": [
+            {"id": name, "fields": {column: "String" for column in
+                                    layer.attributes().columns},
+             "minzoom": zmin, "maxzoom": zmax}
+            for name, layer in layers.items()]}),
+    }
+
+    print(f" |> Creating vector tiles for zoom {zmin}-{zmax} ({out_path})")
+    sink = open_sink(out_path, metadata=metadata)
+    written = 0
+    with con.ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_mvt_worker,
+                                 initargs=(layers, bounds)) as executor:
+        for z in range(zmin, zmax + 1):
+            blocks = tile_blocks(z, bounds)
+            with stage("vector_tiles", workers=max_workers, z=z) as span:
+                futures = {
+                    executor.submit(encode_tile_block, *block, simplify)
+                    for block in blocks
+                }
+                for future in tqdm(con.as_completed(futures),
+                                   total=len(blocks), desc=f"z{z}"):
+                    for tile in future.result():
+                        sink.write(*tile)
+                        span["features"] += 1
+                        span["bytes"] += len(tile[3])
+            written += span["features"]
+    if state is not None:
+        sink.update_metadata({"state": state})
+    sink.close()
+
+    print(f" |> \t Wrote {written} tiles")
@@ -0,0 +1,95 @@
+import pandas as pd
+import shapely
+
+from geopandas import GeoDataFrame
+from pathlib import Path
+
+try:
+    # Only needed for offline extraction from .osm.pbf files
+    import osmium
+except ImportError:
+    osmium = None
+
+
+class _FeatureHandler(osmium.SimpleHandler if osmium else object):
+    def __init__(self, tags, area=None):
+        super().__init__()
+        self.tags = tags
+        # Not `area`, that name is the callback for areas of pyosmium
+        self.clip_area = area
+        self.keys = list(tags)
+        self.factory = osmium.geom.WKBFactory()
+        self.rows = []
+
+    def _append(self, element, osmid, tags, create):
+        # Only keep elements matching any of the tag filters
+        if not any(k in tags if v is True else tags.get(k) in v
+                   for k, v in self.tags.items()):
+            return
+        try:
+            wkb = create()
+        except RuntimeError:
+            # Incomplete geometries, e.g. ways at the border of the extract
+            return
+        if self.clip_area is not None and \
+                not self.clip_area.intersects(shapely.from_wkb(wkb)):
+            return
+
+        row = {k: tags.get(k) for k in self.keys}
+        row.update(element=element, id=osmid, name=tags.get("name"),
+                   geometry=wkb)
+        self.rows.append(row)
+
+    def node(self, n):
+        self._append("node", n.id, n.tags,
+                     lambda: self.factory.create_point(n))
+
+    def way(self, w):
+        # Closed ways are passed on as areas
+        if w.is_closed():
+            return
+        self._append("way", w.id, w.tags,
+                     lambda: self.factory.create_linestring(w))
+
+    def area(self, a):
+        element = "way" if a.from_way() else "relation"
+        self._append(element, a.orig_id(), a.tags,
+                     lambda: self.factory.create_multipolygon(a))
+
+
+def features_from_pbf(pbf_path, tags, area=None):
+    # Streams a (Geofabrik style) .osm.pbf extract and returns the matching
+    # features (within `area` if given) shaped like the results of
+    # `ox.features_from_polygon`
+    if osmium is None:
+        print(" |> Error: Please install 'osmium' to extract from "
+              f"{pbf_path}!")
+        exit(1)
+
+    if area is not None:
+        shapely.prepare(area)
+    handler = _FeatureHandler(tags, area)
+    handler.apply_file(str(Path(pbf_path)), locations=True)
+    if not handler.rows:
+        return None
+
+    rows = pd.DataFrame(handler.rows).set_index(["element", "id"])
+
+    # Areas are always assembled as multipolygons, simple ones are unwrapped
+    # into polygons like osmnx does
+    geometry = shapely.from_wkb(rows["geometry"].to_numpy())
+    simple = (shapely.get_type_id(geometry) == 6) & \
+        (shapely.get_num_geometries(geometry) == 1)
+    geometry[simple] = shapely.get_geometry(geometry[simple], 0)
+    rows["geometry"] = geometry
+
+    return GeoDataFrame(rows, geometry="geometry", crs="EPSG:4326")
+
+
+# Example usage
+if __name__ == "__main__":
+    # Any small extract works, e.g. a Geofabrik Regierungsbezirk
+    path = "freiburg-regbez-latest.osm.pbf"
+    pp = features_from_pbf(path, {"amenity": ["school"], "building": True})
+    # Print the first few rows of the DataFrame to check the output
+    print(pp.head(10))
@@ -1,15 +1,9 @@
-import osmnx as ox
-from pprint import pprint
-from dataclasses import dataclass
-from shapely.geometry import (
-    Point, Polygon, LineString, MultiPolygon, MultiLineString
-)
-from enum import Enum
-from config import debug
+import pandas as pd
 
-# Disable type hints and therefore errors for ox library
-from typing import Any
-ox: Any = ox
+from enum import Enum
+from geopandas import GeoDataFrame
+from extraction import fetch_features
+from metrics import count
 
 
 class Zone(Enum):
@@ -22,60 +16,48 @@ ZONES = [
     member.value for member in Zone.__members__.values()]
 
 
-ShapeType = Point | Polygon | MultiPolygon | LineString | MultiLineString
-
-
-@dataclass(frozen=True)
-class PedestrianZone:
-    zone: Zone
-    name: str | None
-    shape: ShapeType
+def empty_pedestrian_zones():
+    # Columnar result, one row per feature with a categorical zone kind
+    return GeoDataFrame({
+        "zone": pd.Categorical([], categories=ZONES),
+        "name": pd.Series([], dtype="string"),
+    }, geometry=[], crs="EPSG:4326")
 
 
-def extract_pedestrian_zones(place_name, zones=ZONES):
+def extract_pedestrian_zones(place_name, zones=ZONES, *, area=None):
+    # Features of the place, or only the ones within `area` if given
     print(" |> Extracting pedestrian zones")
-    data = []
-
-    for zone in zones:
-        if debug:
-            print(zone)
-        (c, i) = zone.split(":")
-        # Query OpenStreetMap for amenities in the specified place
-        try:
-            g = ox.features_from_place(
-                place_name, tags={c: i}
-            )
-        except ox._errors.InsufficientResponseError:
-            print(f" |> \t Found no features for {zone}. Skipping...")
+    data = empty_pedestrian_zones()
+
+    # Query OpenStreetMap for all zones in the specified place at once
+    g = fetch_features(place_name, zones, area=area)
+    if g is None:
+        print(" |> \t Found no features. Skipping...")
+        return data
+
+    # Detect the zone kind of all features at once, keys are tried in
+    # the order of ZONE_KEYS
+    kinds = pd.Series(None, index=g.index, dtype=object)
+    for k in ZONE_KEYS:
+        if k not in g:
             continue
+        temp = k + ":" + g[k].astype(str)
+        kinds = kinds.where(kinds.notna() | ~temp.isin(zones), temp)
 
-        print(f" |> \t Found {len(g)} features for {zone}")
-
-        for _, attr in g.iterrows():
-            # Detect the institution kind
-            ikey = None
-            for k in ZONE_KEYS:
-                v = str(attr.get(k))
-                temp = f"{k}:{v}"
-                if temp in ZONES:
-                    ikey = temp
-                    break
-
-            if ikey is None:
-                print("Received unexpected zone. Skipping")
-                exit(1)
-
-            zone_ = Zone(ikey)
+    if kinds.isna().any():
+        print("Received unexpected zone. Skipping")
+        exit(1)
 
-            name = attr.get('name', None)
-            if not isinstance(name, str):
-                name = None
+    names = g["name"] if "name" in g else pd.Series(None, index=g.index)
+    data = GeoDataFrame({
+        "zone": pd.Categorical(kinds, categories=ZONES),
+        "name": names.astype("string"),
+    }, geometry=g.geometry.values, crs="EPSG:4326")
 
-            # Append the school's name and geometry
-            data.append(
-                PedestrianZone(
-                    zone=zone_, name=name, shape=attr.geometry
-                ))
+    counts = data["zone"].value_counts()
+    for f in zones:
+        print(f" |> \t Found {counts[f]} features for {f}")
+        count("extraction.features", counts[f], zone=f)
 
     return data
 
@@ -85,4 +67,4 @@ if __name__ == "__main__":
     location = "Waldshut, Baden-Wuerttemberg, Germany"
     pp = extract_pedestrian_zones(location)
     # Print the first few rows of the DataFrame to check the output
-    pprint(pp[:10])
+    print(pp.head(10))
@@ -1,15 +1,9 @@
-import osmnx as ox
-from pprint import pprint
-from dataclasses import dataclass
-from shapely.geometry import (
-    Point, Polygon, LineString, MultiPolygon, MultiLineString
-)
-from enum import Enum
-from config import debug
+import pandas as pd
 
-# Disable type hints and therefore errors for ox library
-from typing import Any
-ox: Any = ox
+from enum import Enum
+from geopandas import GeoDataFrame
+from extraction import fetch_features
+from metrics import count
 
 
 class Institution(Enum):
@@ -28,60 +22,49 @@ INSTITUTION_KEYS = list({
 INSTITUTIONS = [
     member.value for member in Institution.__members__.values()]
 
-ShapeType = Point | Polygon | MultiPolygon | LineString | MultiLineString
-
 
-@dataclass(frozen=True)
-class PublicPlace:
-    institution: Institution
-    name: str | None
-    shape: ShapeType
+def empty_public_places():
+    # Columnar result, one row per feature with a categorical institution kind
+    return GeoDataFrame({
+        "institution": pd.Categorical([], categories=INSTITUTIONS),
+        "name": pd.Series([], dtype="string"),
+    }, geometry=[], crs="EPSG:4326")
 
 
-def extract_public_places(place_name, institutions=INSTITUTIONS):
+def extract_public_places(place_name, institutions=INSTITUTIONS, *, area=None):
+    # Features of the place, or only the ones within `area` if given
     print(" |> Extracting public places")
-    data = []
-
-    for inst in institutions:
-        if debug:
-            print(inst)
-        (c, i) = inst.split(":")
-        # Query OpenStreetMap for amenities in the specified place
-        try:
-            g = ox.features_from_place(
-                place_name, tags={c: i}
-            )
-        except ox._errors.InsufficientResponseError:
-            print(f" |> \t Found no features for {inst}. Skipping...")
+    data = empty_public_places()
+
+    # Query OpenStreetMap for all institutions in the specified place at once
+    g = fetch_features(place_name, institutions, area=area)
+    if g is None:
+        print(" |> \t Found no features. Skipping...")
+        return data
+
+    # Detect the institution kind of all features at once, keys are tried in
+    # the order of INSTITUTION_KEYS
+    kinds = pd.Series(None, index=g.index, dtype=object)
+    for k in INSTITUTION_KEYS:
+        if k not in g:
             continue
+        temp = k + ":" + g[k].astype(str)
+        kinds = kinds.where(kinds.notna() | ~temp.isin(institutions), temp)
 
-        print(f" |> \t Found {len(g)} features for {inst}")
-
-        for _, attr in g.iterrows():
-            # Detect the institution kind
-            ikey = None
-            for k in INSTITUTION_KEYS:
-                v = str(attr.get(k))
-                temp = f"{k}:{v}"
-                if temp in INSTITUTIONS:
-                    ikey = temp
-                    break
-
-            if ikey is None:
-                print("Received unexpected institution. Skipping")
-                exit(1)
-
-            institution = Institution(ikey)
+    if kinds.isna().any():
+        print("Received unexpected institution. Skipping")
+        exit(1)
 
-            name = attr.get('name', None)
-            if not isinstance(name, str):
-                name = None
+    names = g["name"] if "name" in g else pd.Series(None, index=g.index)
+    data = GeoDataFrame({
+        "institution": pd.Categorical(kinds, categories=INSTITUTIONS),
+        "name": names.astype("string"),
+    }, geometry=g.geometry.values, crs="EPSG:4326")
 
-            # Append the school's name and geometry
-            data.append(
-                PublicPlace(
-                    institution=institution, name=name, shape=attr.geometry
-                ))
+    counts = data["institution"].value_counts()
+    for f in institutions:
+        print(f" |> \t Found {counts[f]} features for {f}")
+        count("extraction.features", counts[f], institution=f)
 
     return data
 
@@ -91,4 +74,4 @@ if __name__ == "__main__":
     location = "Waldshut, Baden-Wuerttemberg, Germany"
     pp = extract_public_places(location)
     # Print the first few rows of the DataFrame to check the output
-    pprint(pp[:10])
+    print(pp.head(10))
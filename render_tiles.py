@@ -0,0 +1,492 @@
+import json
+import math
+import struct
+import warnings
+import zlib
+
+import numpy as np
+import shapely
+import concurrent.futures as con
+
+from typing import Any
+from pathlib import Path
+from pyproj import Transformer
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+from tqdm import tqdm
+
+from generate_tif import (
+    COLORMAP,
+    GERMANY,
+    NO_DATA,
+    WindowKind,
+    classify_window,
+    render_german_window,
+)
+from metrics import init_worker, stage, timed, start_run, finish_run
+from state import state_exists, load_state, dirty_regions, state_checksum
+from tile_sinks import (
+    open_sink, partial_metadata, read_metadata, write_metadata
+)
+
+
+TILE_SIZE = 256
+# Tiles are handed out to the workers in blocks of BLOCK_SIZE x BLOCK_SIZE
+BLOCK_SIZE = 16
+# A full render records how far it got every PROGRESS_BLOCKS blocks, so a
+# crashed one continues from there
+PROGRESS_BLOCKS = 64
+# Half of the width of the web mercator plane in meters
+ORIGIN_SHIFT = 20037508.342789244
+
+_to_mercator = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
+
+def parse_zoom(zoom):
+    if isinstance(zoom, str):
+        zmin, _, zmax = zoom.partition("-")
+        return (int(zmin), int(zmax or zmin))
+    return zoom
+
+
+def tile_bounds(z, x, y):
+    # Web mercator bounds of a XYZ tile
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    return (-ORIGIN_SHIFT + x * size, ORIGIN_SHIFT - (y + 1) * size,
+            -ORIGIN_SHIFT + (x + 1) * size, ORIGIN_SHIFT - y * size)
+
+
+def pixel_size(z, minx, miny, maxx, maxy):
+    # Smallest size of a tile pixel in degrees within the bounds, pixels
+    # shrink towards the poles in latitude
+    max_lat = max(abs(miny), abs(maxy))
+    return 360 / (TILE_SIZE * 2 ** z) * math.cos(math.radians(max_lat))
+
+
+def tile_range(z, minx, miny, maxx, maxy):
+    # Inclusive XYZ tile range covering the given lon/lat bounds
+    n = 2 ** z
+
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def tile_y(lat):
+        lat = math.radians(lat)
+        y = (1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n
+        return min(n - 1, max(0, int(y)))
+
+    return (tile_x(minx), tile_y(maxy), tile_x(maxx), tile_y(miny))
+
+
+def to_mercator(shapes):
+    def project(coords):
+        return np.column_stack(_to_mercator.transform(coords[:, 0],
+                                                      coords[:, 1]))
+    return shapely.transform(shapes, project)
+
+
+# RGBA color of every raster value, used to resample tiles by average
+PALETTE = np.array([COLORMAP.get(value, (0, 0, 0, 0))
+                    for value in range(256)], dtype=np.uint8)
+
+
+def encode_png(values):
+    # Paletted PNG using the colormap of the german raster (or a RGBA PNG
+    # for averaged tiles), this is a lot cheaper than going through GDAL for
+    # every single tile
+    height, width = values.shape[:2]
+    rgba = values.ndim == 3
+    raw = np.zeros((height, 1 + width * (4 if rgba else 1)), dtype=np.uint8)
+    raw[:, 1:] = values.reshape(height, -1)
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data)
+        return struct.pack(">I", len(data)) + tag + data + \
+            struct.pack(">I", crc)
+
+    if rgba:
+        header = [
+            chunk(b"IHDR",
+                  struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        ]
+    else:
+        colors = [COLORMAP[value] for value in sorted(COLORMAP)]
+        header = [
+            chunk(b"IHDR",
+                  struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+            chunk(b"PLTE", bytes(c for color in colors for c in color[:3])),
+            chunk(b"tRNS", bytes(color[3] for color in colors)),
+        ]
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        *header,
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)),
+        chunk(b"IEND", b""),
+    ])
+
+
+def read_tile(data, resampling):
+    # Tiles as values (mode) or as RGBA colors (average)
+    if data is None:
+        if resampling == "average":
+            return np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        return np.full((TILE_SIZE, TILE_SIZE), NO_DATA, dtype=np.uint8)
+
+    with warnings.catch_warnings():
+        # Tiles don't carry any georeference
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with MemoryFile(data) as memfile, memfile.open() as src:
+            tile = src.read()
+    if tile.shape[0] == 1:
+        return PALETTE[tile[0]] if resampling == "average" else tile[0]
+    return np.moveaxis(tile, 0, -1)
+
+
+def downsample(mosaic, resampling):
+    # Reduce 2x2 pixels of the combined child tiles to a single pixel
+    height, width = (mosaic.shape[0] // 2, mosaic.shape[1] // 2)
+    blocks = mosaic.reshape(height, 2, width, 2, *mosaic.shape[2:])
+
+    if resampling == "average":
+        return blocks.mean(axis=(1, 3)).round().astype(np.uint8)
+
+    # Most common value, ties are won by the higher value so no smoke
+    # zones don't vanish at low zoom levels
+    values = np.array(sorted(COLORMAP, reverse=True), dtype=np.uint8)
+    counts = (blocks[..., None] == values).sum(axis=(1, 3))
+    return values[counts.argmax(axis=-1)]
+
+
+# Mask geometries of the current worker process in web mercator
+_no_smoke_tree: Any = None
+_probably_tree: Any = None
+_germany_shape: Any = None
+_dirty_region: Any = None
+_interior_png: Any = None
+
+
+def _is_dirty(z, x, y):
+    # Without a dirty region every tile gets (re)rendered
+    return _dirty_region is None or \
+        _dirty_region.intersects(shapely.box(*tile_bounds(z, x, y)))
+
+
+def _remove_tile(tiles, z, x, y):
+    # Tiles that became empty in an incremental run
+    if _dirty_region is not None:
+        tiles.append((z, x, y, None))
+
+
+def _init_tile_worker(no_smoke_layer, probably_layer, germany_layer,
+                      dirty_wkb=None):
+    global _no_smoke_tree, _probably_tree, _germany_shape, _dirty_region
+    global _interior_png
+    init_worker()
+    if dirty_wkb is not None:
+        _dirty_region = to_mercator(shapely.from_wkb(dirty_wkb))
+        shapely.prepare(_dirty_region)
+    _no_smoke_tree = shapely.STRtree(
+        to_mercator(no_smoke_layer.shapes()))
+    if probably_layer is not None:
+        _probably_tree = shapely.STRtree(
+            to_mercator(probably_layer.shapes()))
+    _germany_shape = to_mercator(germany_layer.shape())
+    shapely.prepare(_germany_shape)
+    # Every tile inside of germany without no smoke zones looks the same
+    _interior_png = encode_png(
+        np.full((TILE_SIZE, TILE_SIZE), GERMANY, dtype=np.uint8))
+
+
+def _block_bounds(z, x0, y0, x1, y1):
+    return (*tile_bounds(z, x0, y1)[:2], *tile_bounds(z, x1, y0)[2:])
+
+
+@timed("tiles.block", kind="render")
+def render_tile_block(z, x0, y0, x1, y1):
+    # Encoded tiles of the block as (z, x, y, data), data is None for tiles
+    # that have to be removed
+    window = Window(0, 0, TILE_SIZE, TILE_SIZE)
+    block_bounds = _block_bounds(z, x0, y0, x1, y1)
+    if _dirty_region is not None and \
+            not _dirty_region.intersects(shapely.box(*block_bounds)):
+        return []
+
+    # Skip whole blocks of tiles without anything to render
+    block_kind = classify_window(
+        window=window,
+        transform=from_bounds(*block_bounds, TILE_SIZE, TILE_SIZE),
+        no_smoke_tree=_no_smoke_tree, germany_shape=_germany_shape,
+        probably_tree=_probably_tree)
+    if block_kind == WindowKind.empty and _dirty_region is None:
+        return []
+
+    tiles = []
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            if not _is_dirty(z, x, y):
+                continue
+
+            transform = from_bounds(*tile_bounds(z, x, y),
+                                    TILE_SIZE, TILE_SIZE)
+            kind = block_kind
+            if kind == WindowKind.mixed:
+                kind = classify_window(
+                    window=window, transform=transform,
+                    no_smoke_tree=_no_smoke_tree,
+                    germany_shape=_germany_shape,
+                    probably_tree=_probably_tree)
+
+            if kind == WindowKind.empty:
+                _remove_tile(tiles, z, x, y)
+                continue
+            if kind == WindowKind.interior:
+                data = _interior_png
+            else:
+                world = render_german_window(
+                    window=window, transform=transform,
+                    no_smoke_tree=_no_smoke_tree,
+                    germany_shape=_germany_shape,
+                    probably_tree=_probably_tree)
+                data = encode_png(world[0])
+
+            tiles.append((z, x, y, data))
+
+    return tiles
+
+
+def _block_children(z, x0, y0, x1, y1):
+    # Tiles of the next zoom level below a block
+    return [(z + 1, cx, cy)
+            for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+            for cy in (2 * y, 2 * y + 1) for cx in (2 * x, 2 * x + 1)]
+
+
+@timed("tiles.block", kind="downsample")
+def downsample_tile_block(resampling, children, z, x0, y0, x1, y1):
+    # Same as `render_tile_block`, but built from the (encoded) child tiles
+    # of the block
+    if _dirty_region is not None and not _dirty_region.intersects(
+            shapely.box(*_block_bounds(z, x0, y0, x1, y1))):
+        return []
+
+    tiles = []
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            if not _is_dirty(z, x, y):
+                continue
+
+            data = [children.get((z + 1, cx, cy))
+                    for cy in (2 * y, 2 * y + 1) for cx in (2 * x, 2 * x + 1)]
+            if all(child is None for child in data):
+                _remove_tile(tiles, z, x, y)
+                continue
+
+            quarters = [read_tile(child, resampling) for child in data]
+            mosaic = np.concatenate([
+                np.concatenate(quarters[:2], axis=1),
+                np.concatenate(quarters[2:], axis=1),
+            ], axis=0)
+
+            tiles.append((z, x, y, encode_png(downsample(mosaic, resampling))))
+
+    return tiles
+
+
+def tile_blocks(z, bounds):
+    # Split a zoom level into blocks of tiles covering the bounds
+    tx0, ty0, tx1, ty1 = tile_range(z, *bounds)
+    return [
+        (z, x0, y0,
+         min(x0 + BLOCK_SIZE - 1, tx1), min(y0 + BLOCK_SIZE - 1, ty1))
+        for x0 in range(tx0, tx1 + 1, BLOCK_SIZE)
+        for y0 in range(ty0, ty1 + 1, BLOCK_SIZE)
+    ]
+
+
+def _store_tiles(sink, tiles, span):
+    for z, x, y, data in tiles:
+        if data is None:
+            sink.remove(z, x, y)
+        else:
+            sink.write(z, x, y, data)
+            span["features"] += 1
+            span["bytes"] += len(data)
+
+
+def _run_blocks(executor, submit, blocks, sink, *, max_workers, z,
+                checkpoint=None):
+    # Submits the blocks while at most four per worker are in flight,
+    # finished blocks are stored by this (the only) process writing to the
+    # sink. `checkpoint` is called with the number of leading blocks that
+    # are stored for good
+    pending, index = (set(), {})
+    stored, leading, recorded = (set(), 0, 0)
+    with stage("tiles", workers=max_workers, z=z) as span, \
+            tqdm(total=len(blocks)) as pbar:
+        def store(done):
+            nonlocal leading, recorded
+            for future in done:
+                _store_tiles(sink, future.result(), span)
+                pbar.update(1)
+                stored.add(index.pop(future))
+            while leading in stored:
+                stored.remove(leading)
+                leading += 1
+            if checkpoint is not None and \
+                    leading >= recorded + PROGRESS_BLOCKS:
+                sink.flush()
+                checkpoint(leading)
+                recorded = leading
+
+        for i, block in enumerate(blocks):
+            future = submit(block)
+            pending.add(future)
+            index[future] = i
+            if len(pending) >= 4 * max_workers:
+                done, pending = con.wait(pending,
+                                         return_when=con.FIRST_COMPLETED)
+                store(done)
+        store(con.as_completed(pending))
+    return span["features"]
+
+
+def render_german_tiles(*, out_path, zoom, max_workers,
+                        no_smoke_layer, germany_layer, probably_layer=None,
+                        resampling="mode", dirty_region=None, state=None):
+    # Tiles are written to a MBTiles (.mbtiles) or PMTiles (.pmtiles)
+    # archive, or a z/x/y directory for any other path
+    germany_bounds = germany_layer.bounds()[0]
+    zmin, zmax = parse_zoom(zoom)
+
+    # Only tiles touching the changed region of an existing output are
+    # rendered again
+    dirty_wkb = None
+    if dirty_region is not None and Path(out_path).exists():
+        dirty_wkb = shapely.to_wkb(dirty_region)
+
+    # A full render that crashed left its tiles without a state, it is
+    # continued from the blocks it had stored. Progress is the zoom level
+    # worked on and the number of its leading blocks stored for good
+    job = {"state": state, "zoom": zoom}
+    progress = {"job": job, "z": zmax, "blocks": 0}
+    partial = partial_metadata(out_path)
+    resume = dirty_wkb is None and state is not None and \
+        "state" not in partial and "progress" in partial and \
+        json.loads(partial["progress"])["job"] == job
+    if resume:
+        progress = json.loads(partial["progress"])
+        print(f" |> Resuming germany tiles at zoom {progress['z']} "
+              f"({out_path})")
+    sink = open_sink(out_path, append=dirty_wkb is not None or resume,
+                     metadata={
+        "name": Path(out_path).stem,
+        "format": "png",
+        "minzoom": str(zmin),
+        "maxzoom": str(zmax),
+        "bounds": ",".join(str(b) for b in germany_bounds),
+    })
+
+    def remaining(z):
+        # Blocks of the zoom level the last run did not get to
+        blocks = tile_blocks(z, germany_bounds)
+        if z > progress["z"]:
+            return []
+        return blocks[progress["blocks"]:] if z == progress["z"] \
+            else blocks
+
+    def record_progress(z, blocks):
+        # Only full renders can be continued
+        if dirty_wkb is None and state is not None:
+            sink.update_metadata({"progress": json.dumps(
+                {"job": job, "z": z, "blocks": blocks})})
+
+    def run_level(submit, z):
+        blocks = remaining(z)
+        skipped = len(tile_blocks(z, germany_bounds)) - len(blocks)
+        written = _run_blocks(
+            executor, submit, blocks, sink, max_workers=max_workers, z=z,
+            checkpoint=lambda stored: record_progress(z, skipped + stored))
+        # The next level starts from scratch
+        sink.flush()
+        record_progress(z - 1, 0)
+        return written
+
+    # Use the coarsest geometries that are still accurate for the pixel size
+    pixel = pixel_size(zmax, *germany_bounds)
+    if probably_layer is not None:
+        probably_layer = probably_layer.level(pixel)
+    initargs = (no_smoke_layer.level(pixel), probably_layer,
+                germany_layer.level(pixel), dirty_wkb)
+
+    with con.ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_tile_worker,
+                                 initargs=initargs) as executor:
+        # Only the deepest zoom level is rendered from the masks
+        print(f" |> Rendering germany tiles for zoom {zmax} ({out_path})")
+        written = run_level(
+            lambda block: executor.submit(render_tile_block, *block), zmax)
+
+        # Every coarser level is built from the four child tiles below it
+        def submit_downsample(block):
+            children = {child: sink.read(*child)
+                        for child in _block_children(*block)}
+            children = {child: data for child, data in children.items()
+                        if data is not None}
+            return executor.submit(downsample_tile_block, resampling,
+                                   children, *block)
+
+        for z in range(zmax - 1, zmin - 1, -1):
+            print(f" |> Downsampling germany tiles for zoom {z}")
+            written += run_level(submit_downsample, z)
+
+    # Only complete tile sets record the state they were built from
+    if state is not None:
+        sink.update_metadata({"state": state})
+    sink.close()
+    print(f" |> \t Wrote {written} tiles")
+
+
+# Example usage
+if __name__ == "__main__":
+    # Should be around the number of available cores
+    MAX_WORKERS = 4
+
+    # Only update tiles that changed compared to the previous extraction
+    _incremental = True
+
+    location = "Germany, Baden-Württemberg"
+    start_run("render_tiles")
+
+    if not state_exists(location):
+        print(" |> Error: Please run generate_tif.py first to create the "
+              "mask data")
+        exit(1)
+
+    (public_place_layer, probably_public_place_layer, pedestrian_layer,
+     germany_layer) = load_state(location)
+    state = state_checksum(location)
+    outputs = [
+        ("output/germany_map_public_places.pmtiles", 0, public_place_layer,
+         probably_public_place_layer),
+        ("output/germany_map_pedestrian_zones.pmtiles", 1, pedestrian_layer,
+         None),
+    ]
+    for out_path, mask, no_smoke_layer, probably_layer in outputs:
+        # Tiles are updated from the state they were built from
+        dirty = dirty_regions(location, read_metadata(out_path).get("state")) \
+            if _incremental else None
+        dirty_region = dirty[mask] if dirty is not None else None
+        if dirty_region is not None and dirty_region.is_empty:
+            print(f" |> Tiles are up to date ({out_path})")
+            write_metadata(out_path, {"state": state})
+            continue
+        render_german_tiles(out_path=out_path,
+                            zoom="0-19", max_workers=MAX_WORKERS,
+                            no_smoke_layer=no_smoke_layer,
+                            probably_layer=probably_layer,
+                            germany_layer=germany_layer,
+                            dirty_region=dirty_region, state=state)
+    finish_run()
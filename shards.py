@@ -0,0 +1,569 @@
+import json
+import math
+import os
+import re
+import shutil
+import signal
+import time
+import uuid
+import unicodedata
+
+import numpy as np
+import shapely
+import multiprocessing
+
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+from osgeo import gdal
+
+from config import (
+    shard_queue_folder, shard_lease, shard_cell_size, tile_join_bin
+)
+from boundaries import boundary_shape
+from metrics import init_worker, stage, start_run, finish_run
+from public_places import extract_public_places
+from buildings import extract_buildings
+from pedestrian_zones import extract_pedestrian_zones
+from state import (
+    state_exists, load_state, dump_state, dirty_regions, state_checksum
+)
+from generate_tif import (
+    NO_DATA, create_german_raster, raster_state, record_raster_state
+)
+from generate_mbtiles import join_vector_tiles
+from mvt import create_mbtiles
+from render_tiles import (
+    PALETTE, encode_png, parse_zoom, read_tile, render_german_tiles,
+    tile_range
+)
+from tile_sinks import open_sink, read_metadata, write_metadata
+
+from layers import (
+    NO_SMOKE_DISTANCE,
+    germany_mask_data,
+    smoke_mask_public_place_data,
+    smoke_mask_pedestrian_data,
+)
+
+
+# The states of germany, each one is a shard of a national run
+STATES = [
+    "Baden-Württemberg", "Bayern", "Berlin", "Brandenburg", "Bremen",
+    "Hamburg", "Hessen", "Mecklenburg-Vorpommern", "Niedersachsen",
+    "Nordrhein-Westfalen", "Rheinland-Pfalz", "Saarland", "Sachsen",
+    "Sachsen-Anhalt", "Schleswig-Holstein", "Thüringen",
+]
+
+# Mask layers rendered per shard and merged into the national outputs
+OUTPUTS = ("public_places", "pedestrian_zones")
+
+# Outputs of every shard end up in a folder of its own in here
+SHARD_FOLDER = "output/shards"
+
+# Shard rasters are aligned to the pixel grid starting at this corner, so
+# they mosaic without resampling
+GRID_ORIGIN = (-180.0, 90.0)
+
+
+@dataclass(frozen=True)
+class Shard:
+    # A part of germany that is extracted, masked and tiled on its own,
+    # either a place (state) or a grid cell (minx, miny, maxx, maxy) of the
+    # german outline
+    name: str
+    place: str
+    cell: Any = None
+
+
+def shard_name(text):
+    # File system safe name, e.g. "Baden-Württemberg" -> "baden-wuerttemberg"
+    text = text.lower().replace("ä", "ae").replace("ö", "oe") \
+        .replace("ü", "ue").replace("ß", "ss")
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore")
+    return re.sub(r"[^a-z0-9]+", "-", text.decode()).strip("-")
+
+
+def state_shards():
+    return [Shard(shard_name(state), f"Germany, {state}")
+            for state in STATES]
+
+
+def grid_shards(germany_shape, cell_size):
+    # Grid cells of `cell_size` degrees that touch germany
+    minx, miny, maxx, maxy = germany_shape.bounds
+    shapely.prepare(germany_shape)
+    shards = []
+    for col in range(max(1, math.ceil((maxx - minx) / cell_size))):
+        for row in range(max(1, math.ceil((maxy - miny) / cell_size))):
+            cell = (minx + col * cell_size, miny + row * cell_size,
+                    minx + (col + 1) * cell_size,
+                    miny + (row + 1) * cell_size)
+            if germany_shape.intersects(shapely.box(*cell)):
+                shards.append(Shard(f"cell-{cell_size}-{col}-{row}",
+                                    "Germany", cell))
+    return shards
+
+
+def shard_boundary(shard):
+    if shard.cell is None:
+        return boundary_shape(shard.place)
+    return shapely.intersection(germany_mask_data(), shapely.box(*shard.cell))
+
+
+def extraction_area(boundary, distance):
+    # Features up to `distance` meters outside of the shard still mask
+    # parts of it, meters as degrees of longitude, the larger of both
+    max_lat = np.abs(np.asarray(boundary.bounds)[[1, 3]]).max()
+    degrees = distance / (111320 * np.cos(np.radians(max_lat)))
+    return shapely.buffer(boundary, degrees)
+
+
+def run_shard(shard, *, max_workers, resolution=None, zoom=None,
+              vector_zoom=None, out_dir=SHARD_FOLDER, recover_state=True,
+              incremental=True, resume=True):
+    # Extraction, masking and tiling of a single shard with its own state,
+    # returns the bounds and outputs of the shard for merging
+    print(f" |> Running shard {shard.name} ({shard.place})")
+    folder = Path(out_dir) / shard.name
+    folder.mkdir(parents=True, exist_ok=True)
+
+    with stage("shard", shard=shard.name):
+        if not (recover_state and state_exists(shard.name)):
+            boundary = shard_boundary(shard)
+            area = extraction_area(boundary, NO_SMOKE_DISTANCE)
+            public_places = extract_public_places(shard.place, area=area)
+            pedestrian_zones = extract_pedestrian_zones(shard.place,
+                                                        area=area)
+            buildings = extract_buildings(shard.place, near=public_places,
+                                          distance=NO_SMOKE_DISTANCE)
+
+            print(" |> Extracting mask data")
+            (no_smoke_public_place,
+             probably_public_place) = smoke_mask_public_place_data(
+                public_places, buildings)
+            no_smoke_pedestrian = smoke_mask_pedestrian_data(
+                pedestrian_zones)
+
+            print(" |> Dumping mask data")
+            dump_state(shard.name, no_smoke_public_place,
+                       probably_public_place, no_smoke_pedestrian, boundary)
+            del no_smoke_public_place, probably_public_place
+            del no_smoke_pedestrian, boundary
+
+        (public_place_layer, probably_public_place_layer, pedestrian_layer,
+         germany_layer) = load_state(shard.name)
+        state = state_checksum(shard.name)
+        masks = {
+            "public_places": (public_place_layer,
+                              probably_public_place_layer),
+            "pedestrian_zones": (pedestrian_layer, None),
+        }
+
+        def dirty_region(mask, built_from):
+            # Outputs are updated from the state they were built from
+            dirty = dirty_regions(shard.name, built_from) \
+                if incremental else None
+            return dirty[mask] if dirty is not None else None
+
+        outputs = {}
+        for i, name in enumerate(OUTPUTS):
+            no_smoke_layer, probably_layer = masks[name]
+            tif_path = folder / f"{name}.tif"
+            tif_dirty = dirty_region(i, raster_state(tif_path))
+            # Outputs of masks without any changes are kept as they are,
+            # they were still built from the current state
+            if tif_dirty is not None and tif_dirty.is_empty:
+                record_raster_state(tif_path, state)
+            elif resolution is not None:
+                create_german_raster(out_path=tif_path,
+                                     resolution=resolution,
+                                     max_workers=max_workers,
+                                     no_smoke_layer=no_smoke_layer,
+                                     probably_layer=probably_layer,
+                                     germany_layer=germany_layer,
+                                     dirty_region=tif_dirty,
+                                     resume=resume, state=state,
+                                     grid_origin=GRID_ORIGIN)
+            tiles_path = folder / f"{name}.mbtiles"
+            tiles_dirty = dirty_region(
+                i, read_metadata(tiles_path).get("state"))
+            if tiles_dirty is not None and tiles_dirty.is_empty:
+                write_metadata(tiles_path, {"state": state})
+            elif zoom is not None:
+                render_german_tiles(out_path=tiles_path, zoom=zoom,
+                                    max_workers=max_workers,
+                                    no_smoke_layer=no_smoke_layer,
+                                    probably_layer=probably_layer,
+                                    germany_layer=germany_layer,
+                                    dirty_region=tiles_dirty, state=state)
+            if resolution is not None:
+                outputs[f"{name}.tif"] = str(tif_path)
+            if zoom is not None:
+                outputs[f"{name}.mbtiles"] = str(tiles_path)
+
+        if vector_zoom is not None:
+            vector_path = folder / "vector.mbtiles"
+            create_mbtiles(out_path=vector_path,
+                           layers={
+                               "world_map": germany_layer,
+                               "public_places": public_place_layer,
+                               "public_places_probably":
+                                   probably_public_place_layer,
+                               "pedestrian_zones": pedestrian_layer,
+                           },
+                           zoom=vector_zoom, max_workers=max_workers,
+                           state=state)
+            outputs["vector.mbtiles"] = str(vector_path)
+
+    return {"bounds": [float(b) for b in germany_layer.bounds()[0]],
+            "outputs": outputs}
+
+
+class WorkQueue:
+    # Jobs are JSON files moving through the folders todo -> running ->
+    # done (or failed). A job is claimed by renaming it, which only one
+    # process (or node, on a shared file system) can succeed at. Running
+    # jobs are renewed by touching them, jobs of crashed workers are handed
+    # out again once their lease expired. The name of a running job carries
+    # a token of its claim, so a worker that lost its lease notices
+    STATES = ("todo", "running", "done", "failed")
+
+    def __init__(self, path=shard_queue_folder):
+        self.path = Path(path)
+        for state in self.STATES:
+            (self.path / state).mkdir(parents=True, exist_ok=True)
+        # Job name -> token of the claims of this process
+        self.claims = {}
+
+    def _job_path(self, state, name):
+        return self.path / state / f"{name}.json"
+
+    def _claim_path(self, name, token):
+        return self.path / "running" / f"{name}@{token}.json"
+
+    def _running(self, name):
+        return list((self.path / "running").glob(f"{name}@*.json"))
+
+    def _write(self, state, name, job):
+        # Readers never see a partially written job
+        tmp = self.path / f".{name}-{uuid.uuid4().hex}.tmp"
+        tmp.write_text(json.dumps(job))
+        tmp.replace(self._job_path(state, name))
+
+    def put(self, name, job, *, force=False):
+        # Jobs that are queued, running or done already are kept, unless
+        # forced (failed ones are always queued again)
+        if not force and (self._running(name) or any(
+                self._job_path(state, name).exists()
+                for state in ("todo", "done"))):
+            return False
+        for path in self._running(name):
+            path.unlink(missing_ok=True)
+        for state in ("done", "failed"):
+            self._job_path(state, name).unlink(missing_ok=True)
+        self._write("todo", name, job)
+        return True
+
+    def _take(self, name):
+        # Moves the queued job into running under a new claim
+        token = uuid.uuid4().hex
+        running = self._claim_path(name, token)
+        try:
+            self._job_path("todo", name).rename(running)
+        except FileNotFoundError:
+            # Claimed by someone else in the meantime
+            return None
+        os.utime(running)
+        self.claims[name] = token
+        return json.loads(running.read_text())
+
+    def claim(self):
+        # Next queued job as (name, job), or None if there is none left
+        for path in sorted((self.path / "todo").glob("*.json")):
+            job = self._take(path.stem)
+            if job is not None:
+                return path.stem, job
+        return None
+
+    def renew(self, name):
+        # False once the lease was lost
+        try:
+            os.utime(self._claim_path(name, self.claims[name]))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _finish(self, state, name, **fields):
+        running = self._claim_path(name, self.claims.pop(name))
+        if not running.exists():
+            # The lease expired and the job was queued again, unless
+            # someone else claimed it by now it is taken back
+            print(f" |> Lease of shard {name} was lost")
+            if self._take(name) is None:
+                return False
+            running = self._claim_path(name, self.claims.pop(name))
+        job = json.loads(running.read_text())
+        self._write(state, name, {**job, **fields})
+        running.unlink()
+        return True
+
+    def complete(self, name, result):
+        return self._finish("done", name, result=result)
+
+    def fail(self, name, error):
+        return self._finish("failed", name, error=error)
+
+    def requeue_stale(self, lease=shard_lease):
+        # Jobs of workers that stopped renewing them, e.g. a crashed node
+        requeued = []
+        for path in (self.path / "running").glob("*.json"):
+            name = path.stem.rpartition("@")[0]
+            try:
+                if time.time() - path.stat().st_mtime < lease:
+                    continue
+                path.rename(self._job_path("todo", name))
+            except FileNotFoundError:
+                continue
+            requeued.append(name)
+        return requeued
+
+    def jobs(self, state):
+        jobs = {}
+        for path in sorted((self.path / state).glob("*.json")):
+            try:
+                job = json.loads(path.read_text())
+            except FileNotFoundError:
+                continue
+            jobs[path.stem.rpartition("@")[0] if state == "running"
+                 else path.stem] = job
+        return jobs
+
+
+def enqueue_shards(queue, shards, *, force=False, **settings):
+    # A job per shard, every worker runs it with the same settings
+    queued = [shard.name for shard in shards
+              if queue.put(shard.name, {"shard": asdict(shard),
+                                        "settings": settings}, force=force)]
+    print(f" |> Queued {len(queued)} of {len(shards)} shards ({queue.path})")
+    return queued
+
+
+def _run_job(job, max_workers, sender):
+    # Runs in its own process group, so an aborted shard is stopped along
+    # with its pools and raster writer
+    os.setsid()
+    init_worker()
+    try:
+        result = run_shard(Shard(**job["shard"]), max_workers=max_workers,
+                           **job["settings"])
+    except (Exception, SystemExit) as e:
+        # Errors leave through exit(1) most of the time
+        sender.send(("failed", repr(e)))
+    else:
+        sender.send(("done", result))
+
+
+def _keep_lease(queue, name):
+    # A lease that expired is taken back, unless someone else claimed the
+    # job by now
+    return queue.renew(name) or queue._take(name) is not None
+
+
+def _run_worker(queue_path, max_workers, lease):
+    # Claims and runs jobs until no job is queued or running anymore
+    queue = WorkQueue(queue_path)
+    init_worker()
+    while True:
+        for name in queue.requeue_stale(lease):
+            print(f" |> Lease of shard {name} expired, queued it again")
+        claimed = queue.claim()
+        if claimed is None:
+            # Jobs running elsewhere are queued again if their node crashed
+            if not queue.jobs("running"):
+                return
+            time.sleep(lease / 4)
+            continue
+        name, job = claimed
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_run_job,
+                                          args=(job, max_workers, sender))
+        process.start()
+        sender.close()
+        lost = False
+        while not lost and process.is_alive():
+            process.join(lease / 4)
+            if process.is_alive() and not _keep_lease(queue, name):
+                # The new owner writes the same state and outputs
+                print(f" |> Lease of shard {name} was lost, aborting it")
+                os.killpg(process.pid, signal.SIGKILL)
+                process.join()
+                queue.claims.pop(name)
+                lost = True
+        if lost:
+            continue
+
+        if receiver.poll():
+            outcome, value = receiver.recv()
+        else:
+            outcome, value = ("failed", f"exit code {process.exitcode}")
+        if outcome == "done":
+            queue.complete(name, value)
+        else:
+            print(f" |> Error: Shard {name} failed: {value}")
+            queue.fail(name, value)
+
+
+def work(queue, *, processes, max_workers, lease=shard_lease):
+    # Runs `processes` shards at once on this node, each with a pool of
+    # `max_workers` itself. Pool workers can't start pools of their own, so
+    # every shard worker is a regular process
+    workers = [multiprocessing.Process(target=_run_worker,
+                                       args=(queue.path, max_workers, lease))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = queue.jobs("failed")
+    for name, job in failed.items():
+        print(f" |> Error: Shard {name} failed: {job['error']}")
+    return not failed
+
+
+def composite_tiles(a, b):
+    # Pixel values rank NO_DATA < GERMANY < PROBABLY_SMOKE < NO_SMOKE, so
+    # the maximum of both tiles wins. Averaged (RGBA) tiles keep the more
+    # opaque pixel
+    a, b = (read_tile(a, "mode"), read_tile(b, "mode"))
+    if a.ndim != b.ndim:
+        a, b = (PALETTE[a] if a.ndim == 2 else a,
+                PALETTE[b] if b.ndim == 2 else b)
+    if a.ndim == 2:
+        return encode_png(np.maximum(a, b))
+    return encode_png(np.where(b[..., 3:] > a[..., 3:], b, a))
+
+
+def merge_tiles(inputs, out_path, *, zoom):
+    # Tiles of the shards [(path, bounds)] in a single archive, tiles within
+    # the bounds of an earlier shard may exist already and are composited
+    zmin, zmax = parse_zoom(zoom)
+    bounds = np.array([b for _, b in inputs])
+    bounds = (*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0))
+    print(f" |> Merging {len(inputs)} tile sets ({out_path})")
+
+    sink = open_sink(out_path, metadata={
+        "name": Path(out_path).stem,
+        "format": "png",
+        "minzoom": str(zmin),
+        "maxzoom": str(zmax),
+        "bounds": ",".join(str(float(b)) for b in bounds),
+    })
+    with stage("merge", kind="tiles", path=str(out_path)) as span:
+        for i, (path, _) in enumerate(inputs):
+            # Tile ranges of the earlier shards per zoom level
+            earlier = {z: [tile_range(z, *b) for _, b in inputs[:i]]
+                       for z in range(zmin, zmax + 1)}
+            source = open_sink(path, append=True)
+            for z, x, y, data in source.iter_tiles():
+                if any(x0 <= x <= x1 and y0 <= y <= y1
+                       for x0, y0, x1, y1 in earlier.get(z, ())):
+                    existing = sink.read(z, x, y)
+                    if existing is not None:
+                        data = composite_tiles(existing, data)
+                        span["features"] -= 1
+                sink.write(z, x, y, data)
+                span["features"] += 1
+            source.close()
+    sink.close()
+    print(f" |> \t Wrote {span['features']} tiles")
+
+
+def merge_rasters(in_paths, out_path):
+    # The shard rasters share the resolution, a VRT mosaics them without
+    # copying any pixels. Everything outside of a shard is nodata, so
+    # overlapping shards don't hide each other
+    print(f" |> Merging {len(in_paths)} rasters ({out_path})")
+    with stage("merge", kind="rasters", path=str(out_path)):
+        vrt = gdal.BuildVRT(str(out_path), [str(p) for p in in_paths],
+                            srcNodata=NO_DATA, VRTNodata=NO_DATA)
+        if vrt is None:
+            print(f" |> Error: Merging {out_path} failed!")
+            exit(1)
+        vrt.FlushCache()
+        del vrt
+
+
+def merge_shards(queue, *, out_dir="output", tiles_suffix=".pmtiles"):
+    # National outputs from the results of all finished shards
+    unfinished = [name for state in ("todo", "running", "failed")
+                  for name in queue.jobs(state)]
+    if unfinished:
+        print(f" |> Error: {len(unfinished)} shards are not done yet: "
+              f"{', '.join(unfinished)}")
+        exit(1)
+
+    done = queue.jobs("done")
+    results = [job["result"] for _, job in sorted(done.items())]
+    settings = next(iter(done.values()))["settings"] if done else {}
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    for name in OUTPUTS:
+        rasters = [r["outputs"][f"{name}.tif"] for r in results
+                   if f"{name}.tif" in r["outputs"]]
+        if rasters:
+            merge_rasters(rasters, Path(out_dir) / f"germany_map_{name}.vrt")
+        tiles = [(r["outputs"][f"{name}.mbtiles"], r["bounds"])
+                 for r in results if f"{name}.mbtiles" in r["outputs"]]
+        if tiles:
+            merge_tiles(tiles, Path(out_dir) /
+                        f"germany_map_{name}{tiles_suffix}",
+                        zoom=settings["zoom"])
+
+    vectors = [r["outputs"]["vector.mbtiles"] for r in results
+               if "vector.mbtiles" in r["outputs"]]
+    if vectors:
+        if shutil.which(tile_join_bin) is None:
+            print(f" |> Error: Please install '{tile_join_bin}' to merge "
+                  f"the vector tiles!")
+            exit(1)
+        print(f" |> Merging {len(vectors)} vector tile sets")
+        join_vector_tiles(vectors, str(Path(out_dir) / "germany.mbtiles"))
+
+
+# Example usage
+if __name__ == "__main__":
+    # Shards running at once on this node and workers per shard, together
+    # should be around the number of available cores
+    PROCESSES = 2
+    MAX_WORKERS = 2
+
+    # Every node runs _work on the same (shared) queue folder, one of them
+    # queues the shards first and merges them once all are done
+    _enqueue = True
+    _work = True
+    _merge = True
+    # Queue shards again that are done already and extract them again
+    # instead of recovering their state, e.g. after new OSM data
+    _force = False
+
+    queue = WorkQueue()
+    start_run("shards")
+
+    if _enqueue:
+        shards = grid_shards(germany_mask_data(), shard_cell_size) \
+            if shard_cell_size is not None else state_shards()
+        enqueue_shards(queue, shards, force=_force,
+                       resolution=0.000001, zoom="0-19",
+                       recover_state=not _force)
+
+    if _work:
+        if not work(queue, processes=PROCESSES, max_workers=MAX_WORKERS):
+            exit(1)
+
+    if _merge:
+        merge_shards(queue)
+
+    finish_run()
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from dataclasses import dataclass
+from geopandas import GeoDataFrame
+from pathlib import Path
+
+from config import (
+    osm_pbf_path, buffer_quad_segs, visibility_viewpoint_spacing,
+    visibility_max_viewpoints
+)
+from layers import NO_SMOKE_DISTANCE, LOD_TOLERANCES, lod_levels
+from metrics import stage
+from public_places import INSTITUTIONS
+from pedestrian_zones import ZONES
+
+
+# Bump whenever the layout of the state files or the way their levels
+# are simplified changes
+STATE_VERSION = 4
+LAYERS = ("public_place", "public_place_probably", "pedestrian", "germany")
+
+
+@dataclass(frozen=True)
+class MaskLayer:
+    # Lazy handle of a mask layer in the state store, this is cheap to pass
+    # to worker processes which then memory map the files themselves
+    path: Path
+
+    def _file(self, suffix):
+        return self.path.with_name(self.path.name + suffix)
+
+    def offsets(self):
+        return np.load(self._file(".offsets.npy"), mmap_mode="r")
+
+    def _blob(self, offsets):
+        if not offsets[-1]:
+            return np.empty(0, dtype=np.uint8)
+        return np.memmap(self._file(".wkb"), dtype=np.uint8, mode="r")
+
+    def wkb(self):
+        offsets = self.offsets()
+        blob = self._blob(offsets)
+        return np.array([blob[start:end].tobytes()
+                         for start, end in zip(offsets[:-1], offsets[1:])],
+                        dtype=object)
+
+    def shapes(self):
+        return shapely.from_wkb(self.wkb())
+
+    def shape(self):
+        # Layers holding a single geometry, e.g. the outline of germany
+        return self.shapes()[0]
+
+    def bounds(self):
+        # Spatial index sidecar, the bounds of every geometry
+        return np.load(self._file(".bounds.npy"), mmap_mode="r")
+
+    def index(self):
+        # Index over the bounding boxes only, no geometry needs to be parsed
+        return shapely.STRtree(shapely.box(*np.asarray(self.bounds()).T))
+
+    def attributes(self):
+        if not self._file(".parquet").exists():
+            return pd.DataFrame(index=range(len(self)))
+        return pd.read_parquet(self._file(".parquet"))
+
+    def frame(self):
+        return GeoDataFrame(self.attributes(), geometry=self.shapes(),
+                            crs="EPSG:4326")
+
+    def fingerprint(self):
+        # Changes whenever the layer is written again
+        stat = self._file(".wkb").stat()
+        return f"{self.path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def chunks(self, size):
+        # Attributes and geometries in chunks of `size` rows, only a single
+        # chunk of geometries is parsed at a time
+        offsets = self.offsets()
+        blob = self._blob(offsets)
+        attributes = self.attributes()
+        for start in range(0, len(self), size):
+            bounds = offsets[start:start + size + 1]
+            wkb = [blob[a:b].tobytes()
+                   for a, b in zip(bounds[:-1], bounds[1:])]
+            yield (attributes.iloc[start:start + size],
+                   shapely.from_wkb(wkb))
+
+    def __len__(self):
+        return len(self.offsets()) - 1
+
+    def levels(self):
+        # Precomputed levels of detail as (tolerance, layer), coarsest first
+        prefix = self.path.name + ".lod-"
+        found = {}
+        for f in self.path.parent.glob(prefix + "*.offsets.npy"):
+            name = f.name[:-len(".offsets.npy")]
+            found[float(name[len(prefix):])] = MaskLayer(
+                self.path.with_name(name))
+        return sorted(found.items(), reverse=True)
+
+    def level(self, pixel_size):
+        # Coarsest level that is still accurate for the given pixel size
+        for tolerance, layer in self.levels():
+            if tolerance <= pixel_size / 2:
+                return layer
+        return self
+
+
+def write_layer(path, data):
+    # Geometries are stored as one WKB blob with offsets, which can be
+    # memory mapped, plus their bounds and the remaining attribute columns
+    path = Path(path)
+    if isinstance(data, GeoDataFrame):
+        shapes = data.geometry.to_numpy()
+        attributes = pd.DataFrame(data.drop(columns=data.geometry.name))
+        attributes = attributes.reset_index(
+            drop=not any(attributes.index.names))
+    else:
+        shapes = np.atleast_1d(np.asarray(data, dtype=object))
+        attributes = None
+
+    wkb = shapely.to_wkb(shapes)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(w) for w in wkb])
+
+    layer = MaskLayer(path)
+    with open(layer._file(".wkb"), "wb") as f:
+        for w in wkb:
+            f.write(w)
+    np.save(layer._file(".offsets.npy"), offsets)
+    np.save(layer._file(".bounds.npy"),
+            shapely.bounds(shapes).reshape(-1, 4))
+    if attributes is not None and len(attributes.columns):
+        attributes.to_parquet(layer._file(".parquet"))
+    return layer
+
+
+def source_timestamp():
+    # Overpass results are not versioned, a local extract is
+    if osm_pbf_path is not None:
+        return int(os.path.getmtime(osm_pbf_path))
+    return None
+
+
+def state_key(location):
+    # Everything the stored masks depend on, a different key marks the
+    # stored state as stale
+    return {
+        "version": STATE_VERSION,
+        "location": location,
+        "institutions": INSTITUTIONS,
+        "zones": ZONES,
+        "buffer": NO_SMOKE_DISTANCE,
+        "quad_segs": buffer_quad_segs,
+        "lod": list(LOD_TOLERANCES),
+        "viewpoints": [visibility_viewpoint_spacing,
+                       visibility_max_viewpoints],
+        "source": source_timestamp(),
+    }
+
+
+def state_path(location, *, previous=False):
+    path = Path(f"state/{location}")
+    return path / ("previous" if previous else "current")
+
+
+def _checksum(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _manifest(location, previous):
+    manifest_path = state_path(location, previous=previous) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    return json.loads(manifest_path.read_text())
+
+
+def state_checksum(location, *, previous=False):
+    # Identifies a dumped state, outputs record the one they were built
+    # from
+    manifest_path = state_path(location, previous=previous) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    return _checksum(manifest_path)
+
+
+def state_exists(location, *, previous=False):
+    manifest = _manifest(location, previous)
+    if manifest is None:
+        return False
+    if not previous and manifest["key"] != state_key(location):
+        print(f" |> State of {location} is stale, ignoring it")
+        return False
+    return True
+
+
+def load_state(location, *, previous=False, verify=True):
+    path = state_path(location, previous=previous)
+    manifest = _manifest(location, previous)
+    if manifest is None:
+        print(f" |> Error: No state found for {location}!")
+        exit(1)
+
+    if verify:
+        with stage("state.verify", location=location) as span:
+            for name, checksum in manifest["files"].items():
+                if _checksum(path / name) != checksum:
+                    print(f" |> Error: State file {path / name} is "
+                          f"corrupted!")
+                    exit(1)
+                span["bytes"] += (path / name).stat().st_size
+
+    return tuple(MaskLayer(path / layer) for layer in LAYERS)
+
+
+def dump_state(location, no_smoke_public_place, probably_public_place,
+               no_smoke_pedestrian, germany_shape):
+    base = Path(f"state/{location}")
+    base.mkdir(parents=True, exist_ok=True)
+
+    # Everything is written to a temporary folder first, so a crash never
+    # leaves a half written state behind
+    tmp = base / f".tmp-{uuid.uuid4().hex}"
+    tmp.mkdir()
+    for layer, data in zip(LAYERS, (no_smoke_public_place,
+                                    probably_public_place,
+                                    no_smoke_pedestrian, germany_shape)):
+        with stage("state.dump", location=location, layer=layer) as span:
+            shapes = write_layer(tmp / layer, data).shapes()
+            for tolerance, level in lod_levels(shapes,
+                                               explode=layer != "germany"):
+                write_layer(tmp / f"{layer}.lod-{tolerance}", level)
+            span["features"] = len(shapes)
+            span["bytes"] = sum(f.stat().st_size
+                                for f in tmp.glob(f"{layer}.*"))
+
+    manifest = {
+        "key": state_key(location),
+        "files": {f.name: _checksum(f) for f in sorted(tmp.iterdir())},
+    }
+    (tmp / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+    # Keep the last run around, so the next run can be done incrementally
+    current = state_path(location)
+    previous = state_path(location, previous=True)
+    if current.exists():
+        shutil.rmtree(previous, ignore_errors=True)
+        current.rename(previous)
+    tmp.rename(current)
+
+
+def changed_region(old_layer, new_layer):
+    # Everything covered by a mask geometry that was added or removed,
+    # unchanged geometries have the exact same WKB in both runs. The
+    # simplified levels reach beyond the changed geometries, so they are
+    # compared as well
+    old_levels = dict(old_layer.levels())
+    pairs = [(old_layer, new_layer)] + [
+        (old_levels[tolerance], level)
+        for tolerance, level in new_layer.levels()
+        if tolerance in old_levels]
+
+    changed = []
+    for old_level, new_level in pairs:
+        old = set(old_level.wkb())
+        new = set(new_level.wkb())
+        changed += sorted(old.symmetric_difference(new))
+    return shapely.union_all(shapely.from_wkb(changed))
+
+
+def dirty_regions(location, built_from):
+    # Regions that changed per mask since an output was built from the
+    # state `built_from` (its checksum), or None if it has to be rebuilt.
+    # Only outputs of the current or the previous state can be updated,
+    # older ones missed the changes in between
+    if built_from is None:
+        return None
+    if built_from == state_checksum(location):
+        empty = shapely.GeometryCollection()
+        return (empty, empty)
+    if built_from != state_checksum(location, previous=True):
+        print(f" |> Output of {location} is older than the previous state, "
+              f"rebuilding it")
+        return None
+
+    old_manifest = _manifest(location, True)
+    new_manifest = _manifest(location, False)
+    if old_manifest["key"] != new_manifest["key"] or \
+            old_manifest["files"]["germany.wkb"] != \
+            new_manifest["files"]["germany.wkb"]:
+        return None
+
+    old_public_place, old_probably, old_pedestrian, _ = load_state(
+        location, previous=True, verify=False)
+    new_public_place, new_probably, new_pedestrian, _ = load_state(
+        location, verify=False)
+
+    # Both public place layers end up in the same outputs
+    return (shapely.union(changed_region(old_public_place, new_public_place),
+                          changed_region(old_probably, new_probably)),
+            changed_region(old_pedestrian, new_pedestrian))
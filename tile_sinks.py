@@ -0,0 +1,563 @@
+import gzip
+import hashlib
+import json
+import sqlite3
+import struct
+
+from pathlib import Path
+
+
+# Tiles buffered by the archive sinks before they are written at once
+BATCH_SIZE = 1000
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()
+
+
+class DirectorySink:
+    # One file per tile in a z/x/y tree, like gdal2tiles
+    def __init__(self, path, *, metadata=None, append=False):
+        self.path = Path(path)
+        self.metadata = dict(metadata or {})
+        self.extension = self.metadata.get("format", "png")
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / "metadata.json").unlink(missing_ok=True)
+
+    def _tile_path(self, z, x, y):
+        return self.path / str(z) / str(x) / f"{y}.{self.extension}"
+
+    def write(self, z, x, y, data):
+        tile_path = self._tile_path(z, x, y)
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        tile_path.write_bytes(data)
+
+    def read(self, z, x, y):
+        tile_path = self._tile_path(z, x, y)
+        return tile_path.read_bytes() if tile_path.exists() else None
+
+    def remove(self, z, x, y):
+        self._tile_path(z, x, y).unlink(missing_ok=True)
+
+    def flush(self):
+        # Tiles are written right away
+        pass
+
+    def iter_tiles(self):
+        # All stored tiles as (z, x, y, data)
+        for tile_path in sorted(self.path.glob(f"*/*/*.{self.extension}")):
+            z, x = (int(tile_path.parent.parent.name),
+                    int(tile_path.parent.name))
+            yield (z, x, int(tile_path.stem), tile_path.read_bytes())
+
+    def update_metadata(self, metadata):
+        self.metadata.update(metadata)
+
+    def close(self):
+        # Only complete tile sets have metadata
+        (self.path / "metadata.json").write_text(json.dumps(self.metadata))
+
+
+class MBTilesSink:
+    # Deduplicated MBTiles, identical tiles (e.g. solid or empty ones) are
+    # stored once and referenced by their content hash
+    def __init__(self, path, *, metadata=None, append=False):
+        if not append:
+            Path(path).unlink(missing_ok=True)
+        self.db = sqlite3.connect(path)
+        # Every committed batch survives a crash, so a partially written
+        # archive can be appended to
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY,
+                                                 value TEXT);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                tile_id TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS map_index
+                ON map (zoom_level, tile_column, tile_row);
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY,
+                                               tile_data BLOB);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT zoom_level, tile_column, tile_row, tile_data
+                FROM map JOIN images ON map.tile_id = images.tile_id;
+        """)
+        if metadata:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                    metadata.items())
+        self.pending = []
+
+    def write(self, z, x, y, data):
+        self.pending.append((z, x, y, data))
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        # A single transaction per batch, MBTiles rows count from the
+        # bottom (TMS)
+        if not self.pending:
+            return
+        rows = [(z, x, 2 ** z - 1 - y, _digest(data).hex(), data)
+                for z, x, y, data in self.pending]
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO images VALUES (?, ?)",
+                [(tile_id, data) for *_, tile_id, data in rows])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)",
+                [row[:4] for row in rows])
+        self.pending = []
+
+    def read(self, z, x, y):
+        self.flush()
+        row = self.db.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND "
+            "tile_column = ? AND tile_row = ?",
+            (z, x, 2 ** z - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def remove(self, z, x, y):
+        self.flush()
+        with self.db:
+            self.db.execute(
+                "DELETE FROM map WHERE zoom_level = ? AND tile_column = ? "
+                "AND tile_row = ?", (z, x, 2 ** z - 1 - y))
+
+    def iter_tiles(self):
+        self.flush()
+        for z, x, row, data in self.db.execute(
+                "SELECT zoom_level, tile_column, tile_row, tile_data "
+                "FROM tiles"):
+            yield (z, x, 2 ** z - 1 - row, data)
+
+    def update_metadata(self, metadata):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                metadata.items())
+
+    def close(self):
+        self.flush()
+        with self.db:
+            self.db.execute("DELETE FROM images WHERE tile_id NOT IN "
+                            "(SELECT tile_id FROM map)")
+        # Readers of the finished archive don't need write access for WAL,
+        # unless someone else has it open right now
+        try:
+            self.db.execute("PRAGMA journal_mode = DELETE")
+        except sqlite3.OperationalError:
+            pass
+        self.db.close()
+
+
+# PMTiles v3 header fields, see https://github.com/protomaps/PMTiles
+PMTILES_HEADER = struct.Struct("<7sBQQQQQQQQQQQBBBBBBiiiiBii")
+PMTILES_ROOT_SIZE = 16384 - PMTILES_HEADER.size
+PMTILES_COMPRESSION = {"none": 1, "gzip": 2}
+PMTILES_TYPE = {"pbf": 1, "png": 2, "jpg": 3, "webp": 4}
+
+
+def zxy_to_tile_id(z, x, y):
+    # Position of the tile on the hilbert curve of its zoom level, after
+    # all tiles of the lower zoom levels
+    tile_id = ((1 << (z * 2)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx, ry = (s & x, s & y)
+        tile_id += ((3 * rx) ^ ry) << a
+        if not ry:
+            if rx:
+                x, y = (s - 1 - x, s - 1 - y)
+            x, y = (y, x)
+    return tile_id
+
+
+def tile_id_to_zxy(tile_id):
+    # Inverse of zxy_to_tile_id
+    z, first = (0, 0)
+    while first + (1 << (z * 2)) <= tile_id:
+        first += 1 << (z * 2)
+        z += 1
+    position = tile_id - first
+    x, y = (0, 0)
+    for a in range(z):
+        s = 1 << a
+        rx = 1 & (position >> 1)
+        ry = 1 & (position ^ rx)
+        if not ry:
+            if rx:
+                x, y = (s - 1 - x, s - 1 - y)
+            x, y = (y, x)
+        x, y = (x + s * rx, y + s * ry)
+        position >>= 2
+    return (z, x, y)
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    value, shift = (0, 0)
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def serialize_directory(entries):
+    # Entries are (tile_id, offset, length, run_length) sorted by tile id,
+    # stored column wise with delta encoded tile ids and offsets
+    out = [_varint(len(entries))]
+    last = 0
+    for tile_id, *_ in entries:
+        out.append(_varint(tile_id - last))
+        last = tile_id
+    out += [_varint(run_length) for *_, run_length in entries]
+    out += [_varint(length) for _, _, length, _ in entries]
+    for i, (_, offset, _, _) in enumerate(entries):
+        previous = entries[i - 1] if i else None
+        if previous and offset == previous[1] + previous[2]:
+            out.append(_varint(0))
+        else:
+            out.append(_varint(offset + 1))
+    return gzip.compress(b"".join(out))
+
+
+def deserialize_directory(data):
+    data = gzip.decompress(data)
+    count, pos = _read_varint(data, 0)
+    columns = []
+    for _ in range(4):
+        column = []
+        for _ in range(count):
+            value, pos = _read_varint(data, pos)
+            column.append(value)
+        columns.append(column)
+    deltas, run_lengths, lengths, offsets = columns
+
+    entries = []
+    tile_id = 0
+    for i in range(count):
+        tile_id += deltas[i]
+        offset = offsets[i] - 1 if offsets[i] else \
+            entries[i - 1][1] + entries[i - 1][2]
+        entries.append((tile_id, offset, lengths[i], run_lengths[i]))
+    return entries
+
+
+class PMTilesSink:
+    # Single file PMTiles (v3) archive, tiles are staged in a SQLite file
+    # next to it and the archive is assembled on close, clustered by tile id
+    # and with identical tiles stored once. The staging survives a crash,
+    # appending to it again picks up the tiles written so far
+    def __init__(self, path, *, metadata=None, append=False):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        resume = append and self.tmp_path.exists()
+        if not resume:
+            self.tmp_path.unlink(missing_ok=True)
+        self.db = sqlite3.connect(self.tmp_path)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY,
+                                                 value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (tile_id INTEGER PRIMARY KEY,
+                                              digest BLOB);
+            CREATE TABLE IF NOT EXISTS contents (digest BLOB PRIMARY KEY,
+                                                 data BLOB);
+        """)
+        self.pending = []
+        # Unchanged archives are not assembled again on close
+        self.changed = not (append and self.path.exists()) or resume
+        if append and self.path.exists() and not resume:
+            self._load()
+        if metadata:
+            self.update_metadata(metadata)
+
+    def _load(self):
+        # Existing tiles are copied over into the staging
+        with open(self.path, "rb") as f:
+            header = PMTILES_HEADER.unpack(f.read(PMTILES_HEADER.size))
+            (root_offset, root_length, metadata_offset, metadata_length,
+             leaf_offset, _, data_offset) = header[2:9]
+
+            f.seek(metadata_offset)
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                    json.loads(gzip.decompress(
+                        f.read(metadata_length))).items())
+
+            def entries(offset, length):
+                f.seek(offset)
+                for entry in deserialize_directory(f.read(length)):
+                    if entry[3]:
+                        yield entry
+                    else:
+                        yield from entries(leaf_offset + entry[1], entry[2])
+
+            for tile_id, offset, length, run_length in list(
+                    entries(root_offset, root_length)):
+                f.seek(data_offset + offset)
+                data = f.read(length)
+                for i in range(run_length):
+                    self.pending.append((tile_id + i, data))
+                if len(self.pending) >= BATCH_SIZE:
+                    self.flush()
+        self.flush()
+
+    def write(self, z, x, y, data):
+        self.pending.append((zxy_to_tile_id(z, x, y), data))
+        self.changed = True
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        # A single transaction per batch, like MBTilesSink
+        if not self.pending:
+            return
+        rows = [(tile_id, _digest(data), data)
+                for tile_id, data in self.pending]
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO contents VALUES (?, ?)",
+                [(digest, data) for _, digest, data in rows])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?)",
+                [row[:2] for row in rows])
+        self.pending = []
+
+    def read(self, z, x, y):
+        self.flush()
+        row = self.db.execute(
+            "SELECT data FROM tiles JOIN contents USING (digest) "
+            "WHERE tile_id = ?", (zxy_to_tile_id(z, x, y),)).fetchone()
+        return row[0] if row else None
+
+    def remove(self, z, x, y):
+        self.flush()
+        with self.db:
+            self.db.execute("DELETE FROM tiles WHERE tile_id = ?",
+                            (zxy_to_tile_id(z, x, y),))
+        self.changed = True
+
+    def iter_tiles(self):
+        # All stored tiles as (z, x, y, data), in the order of the archive
+        self.flush()
+        for tile_id, data in self.db.execute(
+                "SELECT tile_id, data FROM tiles JOIN contents "
+                "USING (digest) ORDER BY tile_id"):
+            yield (*tile_id_to_zxy(tile_id), data)
+
+    def update_metadata(self, metadata):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                metadata.items())
+        self.changed = True
+
+    def _directories(self, entries):
+        # A root directory only, or a root pointing to leaf directories if
+        # the root would not fit into the first 16 KiB
+        root = serialize_directory(entries)
+        if len(root) <= PMTILES_ROOT_SIZE:
+            return root, b""
+
+        leaf_size = 4096
+        while True:
+            leaves, pointers = ([], [])
+            offset = 0
+            for i in range(0, len(entries), leaf_size):
+                leaf = serialize_directory(entries[i:i + leaf_size])
+                pointers.append((entries[i][0], offset, len(leaf), 0))
+                leaves.append(leaf)
+                offset += len(leaf)
+            root = serialize_directory(pointers)
+            if len(root) <= PMTILES_ROOT_SIZE:
+                return root, b"".join(leaves)
+            leaf_size *= 2
+
+    def close(self):
+        self.flush()
+        if self.changed:
+            self._assemble()
+        self.db.close()
+        self.tmp_path.unlink()
+
+    def _assemble(self):
+        # Tile data ordered by tile id, runs of identical tiles share one
+        # entry. Only the entries and the offsets of the distinct tiles are
+        # kept in memory
+        entries, offsets = ([], {})
+        data_path = self.path.with_name(self.path.name + ".data")
+        with open(data_path, "w+b") as data:
+            for tile_id, digest in self.db.execute(
+                    "SELECT tile_id, digest FROM tiles ORDER BY tile_id"):
+                if digest not in offsets:
+                    tile_data = self.db.execute(
+                        "SELECT data FROM contents WHERE digest = ?",
+                        (digest,)).fetchone()[0]
+                    offsets[digest] = (data.tell(), len(tile_data))
+                    data.write(tile_data)
+                offset, length = offsets[digest]
+                last = entries[-1] if entries else None
+                if last and last[1] == offset and \
+                        last[0] + last[3] == tile_id:
+                    entries[-1] = (*last[:3], last[3] + 1)
+                else:
+                    entries.append((tile_id, offset, length, 1))
+
+            metadata = dict(self.db.execute(
+                "SELECT name, value FROM metadata"))
+            root, leaves = self._directories(entries)
+            bounds = [float(b) for b in metadata.get(
+                "bounds", "-180,-85,180,85").split(",")]
+            zooms = [0, 0]
+            if entries:
+                last = entries[-1][0] + entries[-1][3] - 1
+                zooms = [tile_id_to_zxy(entries[0][0])[0],
+                         tile_id_to_zxy(last)[0]]
+            tile_type = PMTILES_TYPE.get(metadata.get("format"), 0)
+            tile_compression = PMTILES_COMPRESSION[
+                "gzip" if tile_type == 1 else "none"]
+            metadata = gzip.compress(json.dumps(metadata).encode())
+
+            root_offset = PMTILES_HEADER.size
+            metadata_offset = root_offset + len(root)
+            leaf_offset = metadata_offset + len(metadata)
+            data_offset = leaf_offset + len(leaves)
+            header = PMTILES_HEADER.pack(
+                b"PMTiles", 3,
+                root_offset, len(root), metadata_offset, len(metadata),
+                leaf_offset, len(leaves), data_offset, data.tell(),
+                sum(run_length for *_, run_length in entries), len(entries),
+                len(offsets),
+                1, PMTILES_COMPRESSION["gzip"], tile_compression, tile_type,
+                zooms[0], zooms[-1],
+                *(round(b * 1e7) for b in bounds),
+                zooms[0],
+                round((bounds[0] + bounds[2]) / 2 * 1e7),
+                round((bounds[1] + bounds[3]) / 2 * 1e7))
+
+            # Written under a temporary name, so a crash never leaves a
+            # broken archive behind
+            partial = self.path.with_name(self.path.name + ".partial")
+            with open(partial, "wb") as f:
+                f.write(header + root + metadata + leaves)
+                data.seek(0)
+                while chunk := data.read(1 << 20):
+                    f.write(chunk)
+            partial.replace(self.path)
+        data_path.unlink()
+
+
+def read_metadata(path):
+    # Metadata of an existing tile set, empty if there is none
+    path = Path(path)
+    if path.suffix == ".mbtiles":
+        if not path.exists():
+            return {}
+        db = sqlite3.connect(path)
+        try:
+            return dict(db.execute("SELECT name, value FROM metadata"))
+        except sqlite3.OperationalError:
+            return {}
+        finally:
+            db.close()
+    if path.suffix == ".pmtiles":
+        if not path.exists():
+            return {}
+        with open(path, "rb") as f:
+            header = PMTILES_HEADER.unpack(f.read(PMTILES_HEADER.size))
+            f.seek(header[4])
+            return json.loads(gzip.decompress(f.read(header[5])))
+    metadata_path = path / "metadata.json"
+    if not metadata_path.exists():
+        return {}
+    return json.loads(metadata_path.read_text())
+
+
+def partial_metadata(path):
+    # Metadata of a tile set that is still being written, e.g. by a run
+    # that crashed. Directories are only complete or not at all
+    path = Path(path)
+    if path.suffix == ".pmtiles":
+        tmp_path = path.with_name(path.name + ".tmp")
+        if not tmp_path.exists():
+            return {}
+        db = sqlite3.connect(tmp_path)
+        try:
+            return dict(db.execute("SELECT name, value FROM metadata"))
+        except sqlite3.OperationalError:
+            return {}
+        finally:
+            db.close()
+    if path.suffix == ".mbtiles":
+        return read_metadata(path)
+    return {}
+
+
+def write_metadata(path, metadata):
+    # Updates the metadata of an existing tile set, its tiles are kept as
+    # they are
+    path = Path(path)
+    if path.suffix == ".mbtiles":
+        db = sqlite3.connect(path)
+        with db:
+            db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                           metadata.items())
+        db.close()
+    elif path.suffix == ".pmtiles":
+        # The archive is written again in the layout of PMTilesSink, the
+        # directories and tile data are copied over as they are
+        with open(path, "rb") as f:
+            header = list(PMTILES_HEADER.unpack(f.read(PMTILES_HEADER.size)))
+            f.seek(header[2])
+            root = f.read(header[3])
+            f.seek(header[4])
+            data = gzip.compress(json.dumps({
+                **json.loads(gzip.decompress(f.read(header[5]))),
+                **metadata}).encode())
+            sections = (header[6:8], header[8:10])
+            header[2] = PMTILES_HEADER.size
+            header[4:6] = (header[2] + len(root), len(data))
+            header[6] = header[4] + len(data)
+            header[8] = header[6] + header[7]
+
+            partial = path.with_name(path.name + ".partial")
+            with open(partial, "wb") as out:
+                out.write(PMTILES_HEADER.pack(*header) + root + data)
+                for offset, length in sections:
+                    f.seek(offset)
+                    while length > 0 and \
+                            (chunk := f.read(min(length, 1 << 20))):
+                        out.write(chunk)
+                        length -= len(chunk)
+        partial.replace(path)
+    else:
+        metadata_path = path / "metadata.json"
+        metadata_path.write_text(json.dumps(
+            {**read_metadata(path), **metadata}))
+
+
+def open_sink(path, *, metadata=None, append=False):
+    # The kind of sink is picked by the suffix of the output path
+    suffix = Path(path).suffix
+    if suffix == ".mbtiles":
+        return MBTilesSink(path, metadata=metadata, append=append)
+    if suffix == ".pmtiles":
+        return PMTilesSink(path, metadata=metadata, append=append)
+    return DirectorySink(path, metadata=metadata, append=append)
@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+import numpy as np
+import shapely
+
+from pathlib import Path
+
+from config import (
+    visibility_viewpoint_spacing, visibility_max_viewpoints,
+    visibility_cache_folder
+)
+
+
+def viewpoints(place, *, spacing=visibility_viewpoint_spacing,
+               max_count=visibility_max_viewpoints):
+    # Points on the outline of a place (in meters) that are looked from,
+    # nodes are a single viewpoint
+    outline = place.boundary \
+        if place.geom_type in ("Polygon", "MultiPolygon") else place
+    coords = shapely.get_coordinates(shapely.segmentize(outline, spacing))
+    coords = np.unique(coords, axis=0)
+    if len(coords) > max_count:
+        coords = coords[np.linspace(0, len(coords) - 1, max_count).round()
+                        .astype(int)]
+    return coords
+
+
+def shadows(viewpoint, buildings, reach):
+    # Area hidden behind every building as seen from the viewpoint, the
+    # convex hull of the building and its corners projected `reach` meters
+    # away from the viewpoint
+    coords, index = shapely.get_coordinates(buildings, return_index=True)
+    offset = coords - viewpoint
+    distance = np.maximum(np.hypot(offset[:, 0], offset[:, 1]), 1e-6)
+    far = viewpoint + offset * (reach / distance)[:, None]
+    index = np.concatenate([index, index])
+    order = np.argsort(index, kind="stable")
+    return shapely.convex_hull(shapely.multipoints(
+        np.concatenate([coords, far])[order], indices=index[order]))
+
+
+def visible_area(place, area, buildings, *,
+                 spacing=visibility_viewpoint_spacing,
+                 max_viewpoints=visibility_max_viewpoints):
+    # Part of `area` with a direct line of sight to any viewpoint of the
+    # place, i.e. everything that isn't hidden from all viewpoints
+    if not len(buildings):
+        return area
+
+    # Far enough to leave the area from any viewpoint, even for buildings
+    # right next to one
+    minx, miny, maxx, maxy = area.bounds
+    reach = 4 * np.hypot(maxx - minx, maxy - miny)
+
+    hidden = area
+    for viewpoint in viewpoints(place, spacing=spacing,
+                                max_count=max_viewpoints):
+        hidden = shapely.intersection(
+            hidden, shapely.union_all(shadows(viewpoint, buildings, reach)))
+        if hidden.is_empty:
+            return area
+    return shapely.difference(area, hidden)
+
+
+def cache_key(place_wkb, building_wkb, *params):
+    # Results only depend on the place, the buildings around it and the
+    # parameters of the computation
+    sha = hashlib.sha256(place_wkb)
+    for wkb in sorted(building_wkb):
+        sha.update(wkb)
+    sha.update(repr(params).encode())
+    return sha.hexdigest()
+
+
+def _cache_path(key):
+    return Path(visibility_cache_folder) / key[:2] / f"{key}.wkb"
+
+
+def read_cached(key):
+    path = _cache_path(key)
+    if not path.exists():
+        return None
+    return path.read_bytes()
+
+
+def write_cached(key, wkb):
+    # Written under a temporary name first, workers might race on a key
+    path = _cache_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}")
+    tmp.write_bytes(wkb)
+    tmp.replace(path)